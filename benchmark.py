@@ -0,0 +1,214 @@
+"""
+Benchmarks for the map build pipeline
+
+Runs each stage of UkraineMapWithImages (and the full create_map_with_images
++ save pipeline) at several event counts, each measurement in a fresh
+process, and records wall time, peak RSS and output file size as JSON.
+
+    python benchmark.py                                  # 100, 10k, 100k, 1M events
+    python benchmark.py --sizes 100 10000 --output run.json
+    python benchmark.py --baseline baseline.json         # exit 1 on regressions
+    python benchmark.py --render-modes fast_cluster      # only time one render path
+
+Stages that render markers run once per render mode, pinned instead of
+'auto', so every size times the same code whatever bulk_threshold is.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows: no peak RSS
+    resource = None
+
+DEFAULT_SIZES = [100, 10_000, 100_000, 1_000_000]
+
+STAGES = ['generate', 'generate_table', 'popups', 'markers', 'statistics', 'save', 'full']
+
+# Stages whose work depends on the marker render mode
+RENDERED_STAGES = ('markers', 'save', 'full')
+
+DEFAULT_RENDER_MODES = ['inline', 'fast_cluster']
+
+
+def current_rss_mb():
+    """Resident set size right now, where /proc is available"""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def run_stage(stage, count, output_dir, render_mode=None):
+    """
+    Runs one stage at one event count (in a child process). Setup such as
+    generating the input events is done before the timer starts.
+    """
+    from map import UkraineMapWithImages
+
+    map_obj = UkraineMapWithImages(quiet=True)
+    filename = os.path.join(output_dir, f"{stage}_{count}_{render_mode}.html")
+    output_bytes = None
+
+    # Anything quiet mode does not cover stays out of the timings
+    with contextlib.redirect_stdout(io.StringIO()):
+        events = None
+        if stage not in ('generate', 'generate_table', 'full'):
+            events = list(map_obj.generate_event_table(count, seed=count))
+        if stage == 'save':
+            map_obj.add_markers_with_images(events, render_mode=render_mode, filename=filename)
+            map_obj.add_extended_statistics(events)
+            map_obj.add_legend_with_images()
+            map_obj.add_layers()
+
+        setup_rss = current_rss_mb()
+        start = time.perf_counter()
+
+        if stage == 'generate':
+            map_obj.generate_events_with_images(count)
+        elif stage == 'generate_table':
+            map_obj.generate_event_table(count, seed=count)
+        elif stage == 'popups':
+            for event in events:
+                map_obj.create_popup_with_image(event)
+        elif stage == 'markers':
+            map_obj.add_markers_with_images(events, render_mode=render_mode, filename=filename)
+        elif stage == 'statistics':
+            map_obj.add_extended_statistics(events)
+        elif stage == 'save':
+            map_obj.save(filename)
+        elif stage == 'full':
+            map_obj.create_map_with_images(render_mode=render_mode, count=count, filename=filename)
+            map_obj.save(filename)
+        else:
+            raise ValueError(f"Unknown stage: {stage}")
+
+        wall = time.perf_counter() - start
+
+    if os.path.exists(filename):
+        output_bytes = os.path.getsize(filename)
+        os.remove(filename)
+
+    return {
+        'stage': stage,
+        'events': count,
+        'render_mode': render_mode,
+        'wall_s': round(wall, 4),
+        'peak_rss_mb': round(peak_rss_mb(), 1) if resource is not None else None,
+        'setup_rss_mb': round(setup_rss, 1) if setup_rss is not None else None,
+        'output_bytes': output_bytes,
+    }
+
+
+def run_benchmarks(stages, sizes, timeout, render_modes=DEFAULT_RENDER_MODES):
+    """Runs every stage/size/render mode in its own spawned process"""
+    context = multiprocessing.get_context('spawn')
+    results = []
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        for count in sizes:
+            for stage, render_mode in [(stage, mode) for stage in stages
+                                       for mode in (render_modes if stage in RENDERED_STAGES else [None])]:
+                label = f"{stage}/{render_mode}" if render_mode else stage
+                print(f"⏱️ {label:<26} {count:>9,} events ...", end=' ', flush=True)
+                with context.Pool(1) as pool:
+                    job = pool.apply_async(run_stage, (stage, count, output_dir, render_mode))
+                    try:
+                        result = job.get(timeout)
+                    except multiprocessing.TimeoutError:
+                        result = {'stage': stage, 'events': count, 'render_mode': render_mode, 'error': 'timeout'}
+                    except Exception as e:
+                        result = {'stage': stage, 'events': count, 'render_mode': render_mode, 'error': repr(e)}
+                results.append(result)
+
+                if 'error' in result:
+                    print(f"❌ {result['error']}")
+                else:
+                    print(f"{result['wall_s']:.3f}s, {result['peak_rss_mb']} MB peak")
+
+    return results
+
+
+def find_regressions(results, baseline, tolerance, min_seconds):
+    """Stages slower than baseline * (1 + tolerance), ignoring tiny timings"""
+    previous = {(r['stage'], r['events'], r.get('render_mode')): r for r in baseline['results'] if 'wall_s' in r}
+    regressions = []
+    for result in results:
+        old = previous.get((result['stage'], result['events'], result.get('render_mode')))
+        if old is None or 'wall_s' not in result:
+            continue
+        if result['wall_s'] > old['wall_s'] * (1 + tolerance) and result['wall_s'] - old['wall_s'] > min_seconds:
+            regressions.append({
+                'stage': result['stage'],
+                'events': result['events'],
+                'render_mode': result.get('render_mode'),
+                'baseline_s': old['wall_s'],
+                'wall_s': result['wall_s'],
+                'ratio': round(result['wall_s'] / old['wall_s'], 2) if old['wall_s'] else None,
+            })
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the map build pipeline")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--render-modes', nargs='+', default=DEFAULT_RENDER_MODES,
+                        help="render modes to time the markers, save and full stages with")
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', help="previous results JSON to check for regressions")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed slowdown (0.25 = 25%%)")
+    parser.add_argument('--min-seconds', type=float, default=0.05, help="ignore slowdowns smaller than this")
+    parser.add_argument('--timeout', type=float, default=1800, help="seconds per stage run")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.stages, args.sizes, args.timeout, args.render_modes)
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'results': results,
+    }
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        report['regressions'] = find_regressions(results, baseline, args.tolerance, args.min_seconds)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"💾 Saved: {args.output}")
+
+    for regression in report.get('regressions', []):
+        mode = f"/{regression['render_mode']}" if regression['render_mode'] else ''
+        print(f"🐢 REGRESSION {regression['stage']}{mode} @ {regression['events']:,}: "
+              f"{regression['baseline_s']:.3f}s -> {regression['wall_s']:.3f}s")
+    return 1 if report.get('regressions') else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
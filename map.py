@@ -1,21 +1,2610 @@
+import argparse
+import asyncio
+import codecs
+import cProfile
 import folium
+import functools
+import gzip
+import hashlib
+import heapq
+import html
+import io
+import logging
+import math
+import mimetypes
+import mmap
+import os
+import pstats
 import random
+import re
 import requests
+import shutil
+import sqlite3
+import struct
+import time
+from array import array
+from collections import Counter, deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from branca.element import MacroElement
 from folium import plugins
+from jinja2 import Template
 import json
 
+try:
+    import numpy as np
+except ImportError:  # Only needed for bulk event generation
+    np = None
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:  # Gazetteer then falls back to a GridIndex
+    cKDTree = None
+
+try:
+    import brotli
+except ImportError:  # Static export then writes .gz only
+    brotli = None
+
+# ============================================================================
+# POPUP TEMPLATES
+# ============================================================================
+
+# Popup and tooltip layouts, shared by the inline (Python) and the
+# template (browser) rendering modes so both produce the same HTML
+POPUP_TEMPLATE = """
+        <div style="width: 420px; font-family: 'Segoe UI', Arial, sans-serif;">
+            
+            <!-- Header -->
+            <div style="background: linear-gradient(90deg, {color} 0%, {color}99 100%); 
+                        color: white; padding: 12px; margin: -10px -10px 15px -10px; 
+                        border-radius: 8px 8px 0 0;">
+                <h3 style="margin: 0; font-size: 16px; text-align: center;">
+                    🎯 {type}
+                </h3>
+            </div>
+            
+            <!-- Image -->
+            <div style="text-align: center; margin: 15px 0;">
+                <img src="{image_url}" 
+                     style="width: 100%; max-width: 380px; height: 200px; 
+                            object-fit: cover; border-radius: 8px; 
+                            border: 2px solid #ddd;"
+                     onerror="this.src='https://via.placeholder.com/380x200/cccccc/666666?text=Image+unavailable'"
+                     alt="Image from event location">
+                <div style="font-size: 10px; color: #888; margin-top: 5px;">
+                    Image source: {image_method}
+                </div>
+            </div>
+            
+            <!-- Information -->
+            <div style="background: #f8f9fa; padding: 12px; border-radius: 6px; margin: 10px 0;">
+                <div style="display: grid; grid-template-columns: 1fr 1fr; gap: 8px; font-size: 12px;">
+                    <div><b>📍 City:</b> {city}</div>
+                    <div><b>⏰ Time:</b> {time}</div>
+                    <div><b>📊 Status:</b> {status}</div>
+                    <div><b>🔥 Intensity:</b> {intensity}</div>
+                </div>
+            </div>
+            
+            <!-- Description -->
+            <div style="margin: 12px 0; padding: 10px; background: #fff3cd; 
+                       border-left: 4px solid #ffc107; border-radius: 4px;">
+                <b>📝 Situation description:</b><br>
+                <span style="font-size: 13px;">{description}</span>
+            </div>
+            
+            <!-- Source -->
+            <div style="margin: 12px 0; text-align: center; padding: 8px; 
+                       background: #e9ecef; border-radius: 4px; font-size: 11px;">
+                <b>📡 Information source:</b> {source}<br>
+                <b>🆔 Event ID:</b> #{id:03d}
+            </div>
+            
+            <!-- Coordinates -->
+            <div style="margin-top: 10px; font-size: 10px; color: #666; text-align: center;">
+                📐 Coordinates: {lat:.4f}, {lon:.4f}
+            </div>
+            
+        </div>
+        """
+
+TOOLTIP_TEMPLATE = """
+                <div style="font-size: 12px;">
+                    <b>{type}</b><br>
+                    📍 {city}<br>
+                    ⏰ {time}<br>
+                    📊 {status}
+                </div>
+                """
+
+# Default description of generated events; EventStore only keeps
+# descriptions that differ from it
+DESCRIPTION_TEMPLATE = "{type} in {city} area. Situation monitored by services."
+
+# Marker clustering for the per-type layers
+CLUSTER_OPTIONS = {
+    'disableClusteringAtZoom': 10,  # Uncluster when zoomed in
+    'maxClusterRadius': 50
+}
+
+# Event fields shipped to the browser, coordinates first
+EVENT_FIELDS = (
+    'lat', 'lon', 'id', 'type', 'city', 'color', 'icon', 'time',
+    'status', 'intensity', 'description', 'source', 'image_url', 'image_method'
+)
+
+def template_to_js(template):
+    """
+    Compiles a POPUP_TEMPLATE-style format string into a JS template literal
+    over an event object ``e``
+    """
+    def field(match):
+        name, spec = match.group(1), match.group(2)
+        if spec and spec.startswith('.') and spec.endswith('f'):
+            return f"${{e.{name}.toFixed({int(spec[1:-1])})}}"
+        if spec and spec.endswith('d'):
+            return f"${{String(e.{name}).padStart({int(spec[:-1])}, '0')}}"
+        return f"${{e.{name}}}"
+    
+    body = template.replace('\\', '\\\\').replace('`', '\\`')
+    return '`' + re.sub(r'\{(\w+)(?::([^}]*))?\}', field, body) + '`'
+
+def event_row(event):
+    """Packs an event into a compact list ordered like EVENT_FIELDS"""
+    return [event[field] for field in EVENT_FIELDS]
+
+def script_json(value):
+    """Serializes event rows (or any value) for embedding inside a <script> tag"""
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).replace('</', '<\\/')
+
+# Browser side of the template mode: turns rows back into events and builds
+# markers, popups and tooltips on demand
+EVENT_RUNTIME_JS = """
+var luam = window.luam = window.luam || {};
+luam.fields = %(fields)s;
+luam.row = function (row) {
+    var e = {};
+    for (var i = 0; i < luam.fields.length; i++) {
+        e[luam.fields[i]] = row[i];
+    }
+    return e;
+};
+luam.loadScript = function (url) {
+    // Data files are scripts, so pages also work when opened from disk
+    var script = document.createElement('script');
+    script.src = url;
+    script.onload = script.onerror = function () { script.remove(); };
+    document.head.appendChild(script);
+};
+luam.popupHtml = function (e) {
+    return %(popup)s;
+};
+luam.tooltipHtml = function (e) {
+    return %(tooltip)s;
+};
+luam.bind = function (marker, e) {
+    marker.bindPopup(function () {
+        return '<div style="width: 100.0%%; height: 100.0%%;">' + luam.popupHtml(e) + '</div>';
+    }, {maxWidth: 450});
+    marker.bindTooltip(function () {
+        return '<div>' + luam.tooltipHtml(e) + '</div>';
+    }, {sticky: true});
+    return marker;
+};
+luam.marker = function (e) {
+    return luam.bind(L.marker([e.lat, e.lon], {
+        icon: L.AwesomeMarkers.icon({
+            markerColor: e.color,
+            iconColor: 'white',
+            icon: e.icon,
+            prefix: 'glyphicon',
+            extraClasses: 'fa-rotate-0'
+        })
+    }), e);
+};
+luam.circleMarker = function (e) {
+    luam.canvas = luam.canvas || L.canvas({padding: 0.5});
+    return luam.bind(L.circleMarker([e.lat, e.lon], {
+        renderer: luam.canvas,
+        radius: 5,
+        weight: 1,
+        color: e.color,
+        fillColor: e.color,
+        fillOpacity: 0.8
+    }), e);
+};
+luam.addMarkers = function (layer, rows, start, end, factory) {
+    var markers = [];
+    factory = factory || luam.marker;
+    for (var i = start; i < end; i++) {
+        var e = luam.row(rows[i]);
+        var marker = factory(e);
+        markers.push(marker);
+        if (luam.byId) {
+            luam.byId[e.id] = {marker: marker, layer: layer, type: e.type};
+        }
+    }
+    if (layer.addLayers) {
+        layer.addLayers(markers);
+    } else {
+        markers.forEach(function (marker) { layer.addLayer(marker); });
+    }
+};
+luam.clusterIcon = function (count) {
+    var size = count < 10 ? 30 : count < 100 ? 36 : 44;
+    var color = count < 10 ? 'rgba(110, 204, 57, 0.8)' : count < 100 ? 'rgba(240, 194, 12, 0.8)' : 'rgba(241, 128, 23, 0.8)';
+    return L.divIcon({
+        html: '<div style="width: ' + size + 'px; height: ' + size + 'px; line-height: ' + size + 'px; ' +
+              'border-radius: 50%%; background: ' + color + '; text-align: center; ' +
+              'font: 12px Helvetica Neue, Arial, sans-serif;">' + count + '</div>',
+        className: '',
+        iconSize: [size, size]
+    });
+};
+luam.preclustered = function (map, layer, options) {
+    // options.levels[z - minZoom] is a flat [lat, lon, count, leaf, ...] list;
+    // leaves are the event rows in options.chunks order, one chunk file per
+    // [x, y, count] tile at options.chunkZoom, loaded when first needed.
+    // Above maxZoom the leaves in view are shown
+    var state = luam.leafLayers = luam.leafLayers || {};
+    var chunks = state[options.url] = {rows: {}, loading: {}, offsets: [0], render: render};
+    options.chunks.forEach(function (chunk) {
+        chunks.offsets.push(chunks.offsets[chunks.offsets.length - 1] + chunk[2]);
+    });
+    function tileLat(y) {
+        var n = Math.PI - 2 * Math.PI * y / Math.pow(2, options.chunkZoom);
+        return 180 / Math.PI * Math.atan(0.5 * (Math.exp(n) - Math.exp(-n)));
+    }
+    function tileBounds(chunk) {
+        var n = Math.pow(2, options.chunkZoom);
+        return L.latLngBounds([tileLat(chunk[1] + 1), chunk[0] / n * 360 - 180], [tileLat(chunk[1]), (chunk[0] + 1) / n * 360 - 180]);
+    }
+    function load(c) {
+        if (chunks.rows[c] || chunks.loading[c]) {
+            return;
+        }
+        chunks.loading[c] = true;
+        luam.loadScript(options.url + '/' + c + '.js');
+    }
+    function leafMarker(leaf) {
+        var low = 0, high = options.chunks.length - 1;
+        while (low < high) {
+            var middle = (low + high + 1) >> 1;
+            if (chunks.offsets[middle] <= leaf) {
+                low = middle;
+            } else {
+                high = middle - 1;
+            }
+        }
+        if (!chunks.rows[low]) {
+            load(low);
+            return null;
+        }
+        return luam.marker(luam.row(chunks.rows[low][leaf - chunks.offsets[low]]));
+    }
+    function render() {
+        if (!map.hasLayer(layer)) {
+            return;
+        }
+        var zoom = Math.max(options.minZoom, Math.min(Math.floor(map.getZoom()), options.maxZoom + 1));
+        var bounds = map.getBounds().pad(0.25);
+        var markers = [];
+        var i;
+        if (zoom > options.maxZoom) {
+            options.chunks.forEach(function (chunk, c) {
+                if (!bounds.intersects(tileBounds(chunk))) {
+                    return;
+                }
+                if (!chunks.rows[c]) {
+                    load(c);
+                    return;
+                }
+                chunks.rows[c].forEach(function (row) {
+                    if (bounds.contains([row[0], row[1]])) {
+                        markers.push(luam.marker(luam.row(row)));
+                    }
+                });
+            });
+        } else {
+            var level = options.levels[zoom - options.minZoom];
+            for (i = 0; i < level.length; i += 4) {
+                if (!bounds.contains([level[i], level[i + 1]])) {
+                    continue;
+                }
+                var marker = level[i + 2] === 1 ? leafMarker(level[i + 3]) :
+                    luam.clusterMarker(map, level[i], level[i + 1], level[i + 2], zoom + 2);
+                if (marker) {
+                    markers.push(marker);
+                }
+            }
+        }
+        layer.clearLayers();
+        markers.forEach(function (marker) { layer.addLayer(marker); });
+    }
+    map.on('zoomend moveend', render);
+    layer.on('add', render);
+    render();
+};
+luam.leafChunk = function (url, c, rows) {
+    var chunks = luam.leafLayers[url];
+    chunks.rows[c] = rows;
+    delete chunks.loading[c];
+    chunks.render();
+};
+luam.clusterMarker = function (map, lat, lon, count, zoom) {
+    // A click zooms in on the cluster, to at least zoom
+    var marker = L.marker([lat, lon], {icon: luam.clusterIcon(count)});
+    marker.on('click', function () {
+        map.setView([lat, lon], Math.max(zoom, Math.floor(map.getZoom()) + 2));
+    });
+    return marker;
+};
+luam.startStream = function (map, control, layers, options) {
+    luam.stream = {map: map, control: control, layers: layers, options: options, counts: {}, hidden: {}};
+};
+luam.streamRows = function (rows) {
+    var stream = luam.stream;
+    var typeIndex = luam.fields.indexOf('type');
+    var batches = {};
+    rows.forEach(function (row) {
+        var type = row[typeIndex];
+        (batches[type] = batches[type] || []).push(row);
+    });
+    Object.keys(batches).forEach(function (type) {
+        var layer = stream.layers[type];
+        if (!layer) {
+            layer = stream.layers[type] = L.markerClusterGroup(stream.options).addTo(stream.map);
+        }
+        luam.addMarkers(layer, batches[type], 0, batches[type].length);
+        stream.counts[type] = (stream.counts[type] || 0) + batches[type].length;
+    });
+};
+luam.updateLayers = function () {
+    // Relabels the per-type layers with their counts and hides empty ones
+    var stream = luam.stream;
+    Object.keys(stream.layers).forEach(function (type) {
+        var layer = stream.layers[type];
+        var count = stream.counts[type] || 0;
+        if (stream.control) {
+            stream.control.removeLayer(layer);
+            if (count) {
+                stream.control.addOverlay(layer, type + ' (' + count + ')');
+            }
+        }
+        if (!count && !stream.hidden[type]) {
+            stream.map.removeLayer(layer);
+            stream.hidden[type] = true;
+        } else if (count && stream.hidden[type]) {
+            stream.map.addLayer(layer);
+            delete stream.hidden[type];
+        }
+    });
+};
+luam.setPanel = function (panelHtml) {
+    var panel = document.getElementById('luam-stats-panel');
+    if (!panel) {
+        panel = document.createElement('div');
+        panel.id = 'luam-stats-panel';
+        document.body.appendChild(panel);
+    }
+    panel.innerHTML = panelHtml;
+};
+luam.finishStream = function (panelHtml) {
+    luam.updateLayers();
+    if (panelHtml) {
+        luam.setPanel(panelHtml);
+    }
+};
+luam.removeMarker = function (id) {
+    var entry = luam.byId[id];
+    if (entry) {
+        entry.layer.removeLayer(entry.marker);
+        luam.stream.counts[entry.type] -= 1;
+        delete luam.byId[id];
+    }
+};
+luam.liveRows = function (rows) {
+    var idIndex = luam.fields.indexOf('id');
+    rows.forEach(function (row) { luam.removeMarker(row[idIndex]); });
+    luam.streamRows(rows);
+};
+luam.connectLive = function (url) {
+    // Connects once the page script has run and set luam.liveSequence,
+    // the last published batch already in the page
+    setTimeout(function () {
+        var source = new EventSource(url + '?after=' + (luam.liveSequence || 0));
+        source.addEventListener('events', function (message) {
+            luam.liveRows(JSON.parse(message.data));
+            luam.updateLayers();
+        });
+        source.addEventListener('stats', function (message) {
+            luam.setPanel(JSON.parse(message.data));
+        });
+        source.addEventListener('reload', function () {
+            // Missed batches are no longer in the backlog, only in the page
+            source.close();
+            location.reload();
+        });
+    }, 0);
+};
+luam.pollDelta = function (url, minutes) {
+    function load() {
+        luam.loadScript(url + '?t=' + Date.now());
+    }
+    load();
+    setInterval(load, minutes * 60000);
+};
+luam.applyDelta = function (delta) {
+    if (delta.base !== luam.base) {
+        // The page was rebuilt from scratch since this copy was loaded
+        location.reload();
+        return;
+    }
+    var idIndex = luam.fields.indexOf('id');
+    var applied = false;
+    delta.changesets.forEach(function (changeset) {
+        if (changeset.version <= luam.version) {
+            return;
+        }
+        changeset.remove.forEach(luam.removeMarker);
+        changeset.upsert.forEach(function (row) { luam.removeMarker(row[idIndex]); });
+        luam.streamRows(changeset.upsert);
+        luam.version = changeset.version;
+        applied = true;
+    });
+    if (applied) {
+        luam.finishStream(delta.panel);
+    }
+};
+luam.playback = function (map, layer, options) {
+    // options.buckets maps bucket keys (first..last) to event counts; each
+    // non-empty bucket is a chunk file loaded when it enters the window
+    var play = luam.play = {map: map, layer: layer, options: options, groups: {}, shown: {}, loading: {}, timer: null};
+    var panel = document.createElement('div');
+    panel.id = 'luam-playback';
+    panel.style.cssText = 'position: fixed; bottom: 10px; left: 50%%; transform: translateX(-50%%); z-index: 9999; ' +
+        'background: white; border: 1px solid #ccc; border-radius: 8px; padding: 8px 12px; font-size: 12px; ' +
+        'box-shadow: 0 4px 12px rgba(0,0,0,0.1); display: flex; align-items: center; gap: 8px;';
+    panel.innerHTML = '<button id="luam-play">▶</button>' +
+        '<input id="luam-slider" type="range" min="' + options.first + '" max="' + options.last + '" value="' + options.last + '" style="width: 320px;">' +
+        '<span id="luam-label"></span>' +
+        '<label>window <input id="luam-window" type="number" min="1" value="' + options.window + '" style="width: 48px;"></label>';
+    document.body.appendChild(panel);
+    var slider = document.getElementById('luam-slider');
+    slider.addEventListener('input', function () { luam.showWindow(Number(slider.value)); });
+    document.getElementById('luam-window').addEventListener('change', function () {
+        options.window = Math.max(1, Number(this.value) || 1);
+        luam.showWindow(play.position);
+    });
+    document.getElementById('luam-play').addEventListener('click', function () {
+        if (play.timer) {
+            clearInterval(play.timer);
+            play.timer = null;
+            this.textContent = '▶';
+            return;
+        }
+        this.textContent = '⏸';
+        play.timer = setInterval(function () {
+            var next = play.position >= options.last ? options.first : play.position + 1;
+            slider.value = next;
+            luam.showWindow(next);
+        }, 1000);
+    });
+    luam.showWindow(options.last);
+};
+luam.bucketLabel = function (key) {
+    var options = luam.play.options;
+    var minutes = key * options.bucketMinutes;
+    var pad = function (n) { return String(n).padStart(2, '0'); };
+    if (!options.epoch) {
+        return pad(Math.floor(minutes / 60)) + ':' + pad(minutes %% 60);
+    }
+    var d = new Date(minutes * 60000);
+    return d.getFullYear() + '-' + pad(d.getMonth() + 1) + '-' + pad(d.getDate()) + ' ' + pad(d.getHours()) + ':' + pad(d.getMinutes());
+};
+luam.showWindow = function (position) {
+    var play = luam.play;
+    var from = position - play.options.window + 1;
+    play.position = position;
+    Object.keys(play.shown).forEach(function (key) {
+        key = Number(key);
+        if (key < from || key > position) {
+            play.layer.removeLayer(play.groups[key]);
+            delete play.shown[key];
+        }
+    });
+    var count = 0;
+    for (var key = Math.max(from, play.options.first); key <= position; key++) {
+        if (!play.options.buckets[key]) {
+            continue;
+        }
+        count += play.options.buckets[key];
+        if (play.groups[key]) {
+            if (!play.shown[key]) {
+                play.layer.addLayer(play.groups[key]);
+                play.shown[key] = true;
+            }
+        } else if (!play.loading[key]) {
+            play.loading[key] = true;
+            luam.loadScript(play.options.url + '/' + key + '.js');
+        }
+    }
+    var label = document.getElementById('luam-label');
+    if (label) {
+        label.textContent = (from < position ? luam.bucketLabel(from) + ' – ' : '') + luam.bucketLabel(position) + ' (' + count + ')';
+    }
+};
+luam.playbackChunk = function (key, rows) {
+    var play = luam.play;
+    var group = L.layerGroup();
+    luam.addMarkers(group, rows, 0, rows.length, luam.marker);
+    play.groups[key] = group;
+    delete play.loading[key];
+    if (key > play.position - play.options.window && key <= play.position) {
+        play.layer.addLayer(group);
+        play.shown[key] = true;
+    }
+};
+luam.tiles = function (map, layers, options) {
+    // layers[type] = {group: featureGroup, cluster: markerClusterGroup};
+    // options.tiles lists the non-empty 'z/x/y' tiles with their counts
+    var tiles = luam.tileState = {map: map, layers: layers, options: options, data: {}, markers: {}, shown: {}, loading: {}, wanted: {}};
+    var typeIndex = luam.fields.indexOf('type');
+    function level(zoom) {
+        if (zoom >= options.detail) {
+            return options.detail;
+        }
+        var result = options.levels[0];
+        options.levels.forEach(function (z) {
+            if (z <= zoom) {
+                result = z;
+            }
+        });
+        return result;
+    }
+    function tileX(lon, z) {
+        return Math.floor((lon + 180) / 360 * Math.pow(2, z));
+    }
+    function tileY(lat, z) {
+        var sin = Math.min(Math.max(Math.sin(lat * Math.PI / 180), -0.9999), 0.9999);
+        return Math.floor((0.5 - Math.log((1 + sin) / (1 - sin)) / (4 * Math.PI)) * Math.pow(2, z));
+    }
+    function build(key) {
+        // Aggregate cells are the tiles three levels deeper
+        var payload = tiles.data[key];
+        var z = Number(key.split('/')[0]);
+        var entries = [];
+        var batches = {};
+        (payload.rows || []).forEach(function (row) {
+            (batches[row[typeIndex]] = batches[row[typeIndex]] || []).push(luam.marker(luam.row(row)));
+        });
+        Object.keys(batches).forEach(function (type) {
+            entries.push({layer: layers[type].cluster, markers: batches[type]});
+        });
+        (payload.clusters || []).forEach(function (cluster) {
+            var marker = cluster[3] === 1 && cluster[4] ? luam.marker(luam.row(cluster[4])) :
+                luam.clusterMarker(map, cluster[1], cluster[2], cluster[3], z + 3);
+            entries.push({layer: layers[options.types[cluster[0]]].group, markers: [marker]});
+        });
+        return entries;
+    }
+    function show(key) {
+        var entries = tiles.markers[key] = tiles.markers[key] || build(key);
+        entries.forEach(function (entry) {
+            if (entry.layer.addLayers) {
+                entry.layer.addLayers(entry.markers);
+            } else {
+                entry.markers.forEach(function (marker) { entry.layer.addLayer(marker); });
+            }
+        });
+        tiles.shown[key] = true;
+    }
+    function hide(key) {
+        tiles.markers[key].forEach(function (entry) {
+            if (entry.layer.removeLayers) {
+                entry.layer.removeLayers(entry.markers);
+            } else {
+                entry.markers.forEach(function (marker) { entry.layer.removeLayer(marker); });
+            }
+        });
+        delete tiles.shown[key];
+    }
+    luam.showTiles = function () {
+        var z = level(Math.floor(map.getZoom()));
+        var bounds = map.getBounds();
+        var wanted = {};
+        for (var x = tileX(bounds.getWest(), z); x <= tileX(bounds.getEast(), z); x++) {
+            for (var y = tileY(bounds.getNorth(), z); y <= tileY(bounds.getSouth(), z); y++) {
+                var key = z + '/' + x + '/' + y;
+                if (!options.tiles[key]) {
+                    continue;
+                }
+                wanted[key] = true;
+                if (tiles.data[key]) {
+                    if (!tiles.shown[key]) {
+                        show(key);
+                    }
+                } else if (!tiles.loading[key]) {
+                    tiles.loading[key] = true;
+                    luam.loadScript(options.url + '/' + key + '.js');
+                }
+            }
+        }
+        Object.keys(tiles.shown).forEach(function (key) {
+            if (!wanted[key]) {
+                hide(key);
+            }
+        });
+        tiles.wanted = wanted;
+    };
+    luam.tile = function (key, payload) {
+        tiles.data[key] = payload;
+        delete tiles.loading[key];
+        if (tiles.wanted[key] && !tiles.shown[key]) {
+            show(key);
+        }
+    };
+    map.on('moveend zoomend', luam.showTiles);
+    luam.showTiles();
+};
+""" % {
+    'fields': json.dumps(list(EVENT_FIELDS)),
+    'popup': template_to_js(POPUP_TEMPLATE),
+    'tooltip': template_to_js(TOOLTIP_TEMPLATE),
+}
+
+class EventRuntime(MacroElement):
+    """
+    JS popup/tooltip templates for the template rendering mode
+    """
+    
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            {{ this.code }}
+        {% endmacro %}
+    """)
+    
+    def __init__(self):
+        super().__init__()
+        self._name = 'EventRuntime'
+        self.code = EVENT_RUNTIME_JS
+
+class TemplatedEventData(MacroElement):
+    """
+    Event records written once to the page as a compact JSON array
+    """
+    
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = {{ this.rows_json }};
+        {% endmacro %}
+    """)
+    
+    def __init__(self, rows):
+        super().__init__()
+        self._name = 'TemplatedEventData'
+        self.rows_json = script_json(rows)
+
+class TemplatedMarkers(MacroElement):
+    """
+    Adds the markers for a slice of a TemplatedEventData to its parent layer
+
+    factory is the runtime function building each marker: 'marker' for
+    icon markers, 'circleMarker' for canvas-rendered circles
+    """
+    
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            luam.addMarkers({{ this._parent.get_name() }}, {{ this.data.get_name() }}, {{ this.start }}, {{ this.end }}, luam.{{ this.factory }});
+        {% endmacro %}
+    """)
+    
+    def __init__(self, data, start, end, factory='marker'):
+        super().__init__()
+        self._name = 'TemplatedMarkers'
+        self.data = data
+        self.start = start
+        self.end = end
+        self.factory = factory
+
+class PreclusteredMarkers(MacroElement):
+    """
+    Shows the server-side clusters of a ZoomClusterer for the current zoom
+    level in its parent layer, loading the leaf chunk files written by
+    add_markers_with_images for single events and past the last
+    clustered zoom
+    """
+    
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            luam.preclustered(
+                {{ this._parent._parent.get_name() }},
+                {{ this._parent.get_name() }},
+                {{ this.options_json }}
+            );
+        {% endmacro %}
+    """)
+    
+    def __init__(self, options):
+        super().__init__()
+        self._name = 'PreclusteredMarkers'
+        self.options_json = script_json(options)
+
+# FastMarkerCluster callback building markers from EVENT_FIELDS rows
+FAST_MARKER_CALLBACK = "function (row) { return luam.marker(luam.row(row)); }"
+
+class EventStreamSlot(MacroElement):
+    """
+    Marks where save_streaming writes event chunks into the map script
+    """
+    
+    token = '/*__LUAM_EVENT_STREAM__*/'
+    
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            luam.startStream(
+                {{ this._parent.get_name() }},
+                {{ this.control.get_name() if this.control else 'null' }},
+                { {%- for event_type, layer in this.layers.items() %}
+                    {{ event_type|tojson }}: {{ layer.get_name() }},
+                {%- endfor %} },
+                {{ this.options|tojson }}
+            );
+            {{ this.token }}
+        {% endmacro %}
+    """)
+    
+    def __init__(self, layers, control, options):
+        super().__init__()
+        self._name = 'EventStreamSlot'
+        self.layers = layers
+        self.control = control
+        self.options = options
+
+class DeltaPoller(MacroElement):
+    """
+    Makes a streamed page track the delta file of create_map_incremental
+    """
+    
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            luam.base = {{ this.base|tojson }};
+            luam.version = 0;
+            luam.byId = {};
+            luam.pollDelta({{ this.url|tojson }}, {{ this.poll_minutes }});
+        {% endmacro %}
+    """)
+    
+    def __init__(self, url, base, poll_minutes=15):
+        super().__init__()
+        self._name = 'DeltaPoller'
+        self.url = url
+        self.base = base
+        self.poll_minutes = poll_minutes
+
+class LiveUpdates(MacroElement):
+    """
+    Connects a page served by LiveMapServer to its Server-Sent Events stream
+    """
+    
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            luam.byId = {};
+            luam.connectLive({{ this.url|tojson }});
+        {% endmacro %}
+    """)
+    
+    def __init__(self, url='/events'):
+        super().__init__()
+        self._name = 'LiveUpdates'
+        self.url = url
+
+class TimePlayback(MacroElement):
+    """
+    Time slider over the bucket chunks written by add_playback_layer;
+    markers of the buckets in the window are shown in the parent layer
+    """
+    
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            luam.playback(
+                {{ this._parent._parent.get_name() }},
+                {{ this._parent.get_name() }},
+                {{ this.options|tojson }}
+            );
+        {% endmacro %}
+    """)
+    
+    def __init__(self, options):
+        super().__init__()
+        self._name = 'TimePlayback'
+        self.options = options
+
+class TiledMarkers(MacroElement):
+    """
+    Loads the tile files written by add_tiled_markers for the current
+    viewport into the per-type layers
+    """
+    
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            luam.tiles(
+                {{ this._parent.get_name() }},
+                { {%- for event_type, (group, cluster) in this.layers.items() %}
+                    {{ event_type|tojson }}: {group: {{ group.get_name() }}, cluster: {{ cluster.get_name() }}},
+                {%- endfor %} },
+                {{ this.options|tojson }}
+            );
+        {% endmacro %}
+    """)
+    
+    def __init__(self, layers, options):
+        super().__init__()
+        self._name = 'TiledMarkers'
+        self.layers = layers
+        self.options = options
+
+class ImageCatalog:
+    """
+    Index of the images in the Pics folder
+
+    The folder is scanned once and files are indexed by name, extension and
+    optional tags taken from the file name, e.g. ``missile-strike_kyiv_3.jpg``
+    is tagged with the event type "Missile strike" and the city "Kyiv".
+    The index is rebuilt only when the folder modification time changes.
+    """
+
+    IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+
+    def __init__(self, folder="Pics", instrumentation=None):
+        self.folder = folder
+        self.instrumentation = instrumentation or Instrumentation()
+        self.files = []
+        self.by_name = {}
+        self.by_extension = {}
+        self.by_tag = {}
+        self._candidates = {}
+        self._mtime = None
+        # Original path -> {size name: thumbnail path}, from the ThumbnailPipeline manifest
+        self.thumbnails = {}
+        self.thumbnail_manifest = os.path.join(folder, 'thumbs', 'manifest.json')
+        self._manifest_mtime = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        self._ensure_loaded()
+        return len(self.files)
+
+    @staticmethod
+    def slug(value):
+        """Normalizes a city, event type or file name tag for lookups"""
+        return re.sub(r'[^a-z0-9]+', '-', str(value).lower()).strip('-')
+
+    def refresh(self):
+        """Rescans the folder if it changed since the last scan"""
+        if not os.path.isdir(self.folder):
+            self.instrumentation.warn("⚠️ Pics folder not found, creating it...")
+            os.makedirs(self.folder, exist_ok=True)
+
+        mtime = os.stat(self.folder).st_mtime_ns
+        if mtime != self._mtime:
+            self._scan()
+            self._mtime = mtime
+            if not self.files:
+                self.instrumentation.warn("⚠️ No images found in Pics folder")
+        
+        manifest_mtime = (os.stat(self.thumbnail_manifest).st_mtime_ns
+                          if os.path.exists(self.thumbnail_manifest) else None)
+        if manifest_mtime != self._manifest_mtime:
+            self._load_thumbnails()
+            self._manifest_mtime = manifest_mtime
+        return self
+
+    def _load_thumbnails(self):
+        """Attaches the thumbnails of a previous ThumbnailPipeline run that are still fresh"""
+        manifest = {}
+        if os.path.exists(self.thumbnail_manifest):
+            with open(self.thumbnail_manifest, encoding='utf-8') as f:
+                manifest = json.load(f)
+        self.thumbnails = {}
+        for path in self.files:
+            entry = manifest.get(path)
+            if entry and self.thumbnails_fresh(entry, os.stat(path)):
+                self.thumbnails[path] = entry['outputs']
+
+    @staticmethod
+    def thumbnails_fresh(entry, stat, sizes=None):
+        """Whether a manifest entry matches its source file and has every thumbnail size"""
+        return (entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns
+                and set(entry['outputs']) == set(sizes or THUMBNAIL_SIZES)
+                and all(os.path.exists(output) for output in entry['outputs'].values()))
+
+    def _ensure_loaded(self):
+        if self._mtime is None:
+            self.refresh()
+
+    def _scan(self):
+        files = []
+        by_name = {}
+        by_extension = {}
+        by_tag = {}
+
+        with os.scandir(self.folder) as entries:
+            for entry in sorted(entries, key=lambda e: e.name):
+                if not entry.is_file():
+                    continue
+                stem, extension = os.path.splitext(entry.name)
+                extension = extension.lower()
+                if extension not in self.IMAGE_EXTENSIONS:
+                    continue
+
+                # Forward slashes for web compatibility
+                web_path = os.path.join(self.folder, entry.name).replace('\\', '/')
+                files.append(web_path)
+                by_name[entry.name] = web_path
+                by_extension.setdefault(extension, []).append(web_path)
+
+                # Tags are the non-numeric parts of the name between underscores
+                for part in stem.split('_'):
+                    tag = self.slug(part)
+                    if tag and not tag.isdigit():
+                        by_tag.setdefault(tag, []).append(web_path)
+
+        self.files = files
+        self.by_name = by_name
+        self.by_extension = by_extension
+        self.by_tag = by_tag
+        self._candidates = {}
+
+    def candidates(self, city="", event_type=""):
+        """
+        Returns the images matching an event, most specific tags first:
+        type and city, then type, then city, then every image
+        """
+        self._ensure_loaded()
+        key = (city, event_type)
+        pool = self._candidates.get(key)
+        if pool is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            type_images = self.by_tag.get(self.slug(event_type), []) if event_type else []
+            city_images = self.by_tag.get(self.slug(city), []) if city else []
+            city_set = set(city_images)
+            pool = ([path for path in type_images if path in city_set]
+                    or type_images or city_images or self.files)
+            self._candidates[key] = pool
+        return pool
+
+    def pick(self, city="", event_type=""):
+        """Picks a random image for an event, or None if there are no images"""
+        pool = self.candidates(city, event_type)
+        return random.choice(pool) if pool else None
+
+    def thumbnail(self, path, size='popup'):
+        """Returns the thumbnail of an image if one was generated, else the image"""
+        return self.thumbnails.get(path, {}).get(size, path)
+
+# Thumbnail sizes (width, height), matching how popups show images
+THUMBNAIL_SIZES = {
+    'popup': (380, 200)
+}
+
+def make_thumbnails(source, output_folder, sizes, quality=82):
+    """
+    Resizes one image to every thumbnail size (runs in a worker process)
+
+    Outputs are named by a hash of the source content, so unchanged images
+    map to the same files and browsers can cache them indefinitely.
+    """
+    from PIL import Image, ImageOps
+    
+    with open(source, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()[:16]
+    
+    outputs = {}
+    image = None
+    for name, (width, height) in sizes.items():
+        path = os.path.join(output_folder, f"{digest}_{width}x{height}.jpg")
+        if not os.path.exists(path):
+            if image is None:
+                image = ImageOps.exif_transpose(Image.open(io.BytesIO(data))).convert('RGB')
+            # Crop to fill, like object-fit: cover in the popup
+            thumb = ImageOps.fit(image, (width, height), Image.LANCZOS)
+            thumb.save(path + '.tmp', 'JPEG', quality=quality, optimize=True, progressive=True)
+            os.replace(path + '.tmp', path)
+        outputs[name] = path.replace('\\', '/')
+    
+    return source, digest, outputs
+
+class ThumbnailPipeline:
+    """
+    Builds popup thumbnails for the images of an ImageCatalog
+
+    Images are resized in parallel with a process pool. A manifest in the
+    output folder records each source's size and mtime, so images that
+    have not changed since the last run are skipped without being read.
+    """
+
+    def __init__(self, catalog, output_folder=None, sizes=THUMBNAIL_SIZES, quality=82, processes=None,
+                 instrumentation=None):
+        self.catalog = catalog
+        self.instrumentation = instrumentation or catalog.instrumentation
+        self.output_folder = output_folder or os.path.dirname(catalog.thumbnail_manifest)
+        self.sizes = sizes
+        self.quality = quality
+        self.processes = processes
+        self.manifest_path = os.path.join(self.output_folder, 'manifest.json')
+
+    def run(self):
+        """Updates the thumbnails and attaches them to the catalog"""
+        try:
+            import PIL  # noqa: F401
+        except ImportError:
+            raise ImportError("Thumbnails require Pillow: pip install pillow")
+        
+        self.catalog.refresh()
+        os.makedirs(self.output_folder, exist_ok=True)
+        
+        manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, encoding='utf-8') as f:
+                manifest = json.load(f)
+        
+        pending = []
+        fresh = {}
+        for path in self.catalog.files:
+            stat = os.stat(path)
+            entry = manifest.get(path)
+            if entry and ImageCatalog.thumbnails_fresh(entry, stat, self.sizes):
+                fresh[path] = entry
+            else:
+                pending.append((path, stat))
+        
+        if pending:
+            self.instrumentation.say(f"🖼️ Creating thumbnails for {len(pending)} images...")
+            paths = [path for path, stat in pending]
+            with ProcessPoolExecutor(self.processes) as pool:
+                results = pool.map(
+                    make_thumbnails, paths,
+                    [self.output_folder] * len(paths),
+                    [self.sizes] * len(paths),
+                    [self.quality] * len(paths)
+                )
+                for (path, stat), (source, digest, outputs) in zip(pending, results):
+                    fresh[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                                   'digest': digest, 'outputs': outputs}
+        
+        with open(self.manifest_path, 'w', encoding='utf-8') as f:
+            json.dump(fresh, f, indent=1)
+        
+        self.catalog.thumbnails = {path: entry['outputs'] for path, entry in fresh.items()}
+        return {'created': len(pending), 'skipped': len(fresh) - len(pending)}
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = 111.32
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two points in km"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+class GridIndex:
+    """
+    Uniform lat/lon grid over points for bounding-box, radius and
+    k-nearest queries
+
+    Items are stored in cells of cell_size degrees, so a query only looks
+    at the cells it overlaps instead of scanning every point.
+    """
+
+    def __init__(self, cell_size=0.1):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.count = 0
+        self._rows = None
+        self._cols = None
+
+    def __len__(self):
+        return self.count
+
+    def _cell(self, lat, lon):
+        return math.floor(lat / self.cell_size), math.floor(lon / self.cell_size)
+
+    def insert(self, lat, lon, item):
+        """Adds an item at a position"""
+        cell = self._cell(lat, lon)
+        self.cells.setdefault(cell, []).append((lat, lon, item))
+        self.count += 1
+        
+        # Occupied extent, bounds the nearest-neighbour ring search
+        row, col = cell
+        if self._rows is None:
+            self._rows = [row, row]
+            self._cols = [col, col]
+        else:
+            self._rows = [min(self._rows[0], row), max(self._rows[1], row)]
+            self._cols = [min(self._cols[0], col), max(self._cols[1], col)]
+
+    def insert_events(self, events):
+        """Adds events by their lat/lon"""
+        for event in events:
+            self.insert(event['lat'], event['lon'], event)
+
+    def bbox(self, south, west, north, east):
+        """Returns the items inside a bounding box"""
+        row0, col0 = self._cell(south, west)
+        row1, col1 = self._cell(north, east)
+        
+        # Walk whichever is smaller: the covered cells or the occupied ones
+        if (row1 - row0 + 1) * (col1 - col0 + 1) <= len(self.cells):
+            cells = (self.cells.get((row, col), ())
+                     for row in range(row0, row1 + 1) for col in range(col0, col1 + 1))
+        else:
+            cells = (points for (row, col), points in self.cells.items()
+                     if row0 <= row <= row1 and col0 <= col <= col1)
+        
+        return [item for points in cells for lat, lon, item in points
+                if south <= lat <= north and west <= lon <= east]
+
+    def within_radius(self, lat, lon, radius_km):
+        """Returns the items within radius_km of a point, nearest first"""
+        dlat = radius_km / KM_PER_DEGREE
+        dlon = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+        
+        found = []
+        row0, col0 = self._cell(lat - dlat, lon - dlon)
+        row1, col1 = self._cell(lat + dlat, lon + dlon)
+        for row in range(row0, row1 + 1):
+            for col in range(col0, col1 + 1):
+                for point_lat, point_lon, item in self.cells.get((row, col), ()):
+                    distance = haversine_km(lat, lon, point_lat, point_lon)
+                    if distance <= radius_km:
+                        found.append((distance, item))
+        
+        found.sort(key=lambda x: x[0])
+        return [item for distance, item in found]
+
+    def nearest(self, lat, lon, k=1):
+        """Returns the k nearest items as (distance_km, item), nearest first"""
+        if not self.count:
+            return []
+        
+        row, col = self._cell(lat, lon)
+        best = []
+        ring = 0
+        max_ring = max(abs(row - self._rows[0]), abs(row - self._rows[1]),
+                       abs(col - self._cols[0]), abs(col - self._cols[1]))
+        
+        while ring <= max_ring:
+            for cell in self._ring(row, col, ring):
+                for point_lat, point_lon, item in self.cells.get(cell, ()):
+                    best.append((haversine_km(lat, lon, point_lat, point_lon), id(item), item))
+            if len(best) >= k:
+                best = heapq.nsmallest(k, best, key=lambda x: x[0])
+                if best[-1][0] <= self._searched_km(lat, lon, row, col, ring):
+                    break
+            ring += 1
+        
+        return [(distance, item) for distance, _, item in sorted(best, key=lambda x: x[0])[:k]]
+
+    def _ring(self, row, col, ring):
+        if ring == 0:
+            yield row, col
+            return
+        for c in range(col - ring, col + ring + 1):
+            yield row - ring, c
+            yield row + ring, c
+        for r in range(row - ring + 1, row + ring):
+            yield r, col - ring
+            yield r, col + ring
+
+    def _searched_km(self, lat, lon, row, col, ring):
+        """Lower bound on the distance to any point outside the searched rings"""
+        size = self.cell_size
+        south = (row - ring) * size
+        north = (row + ring + 1) * size
+        west = (col - ring) * size
+        east = (col + ring + 1) * size
+        widest = max(abs(south), abs(north))
+        lon_km = KM_PER_DEGREE * max(math.cos(math.radians(min(widest, 90.0))), 0.0)
+        return min((lat - south) * KM_PER_DEGREE, (north - lat) * KM_PER_DEGREE,
+                   (lon - west) * lon_km, (east - lon) * lon_km)
+
+class ZoomClusterer:
+    """
+    Hierarchical point clusters per zoom level, computed in Python
+
+    Points are projected to Web Mercator and binned into power-of-two
+    grid cells about radius pixels wide at each zoom, so the clusters of
+    one zoom nest inside those of the zoom below. Counts and weighted
+    centroids are computed with vectorized NumPy aggregation.
+    """
+
+    def __init__(self, radius=50, min_zoom=0, max_zoom=9):
+        self.radius = radius
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        # Cells are 256 / 2**cell_bits pixels wide at every zoom
+        self.cell_bits = max(0, round(math.log2(256 / radius)))
+
+    @staticmethod
+    def project(lats, lons):
+        """Web Mercator x/y in [0, 1]"""
+        x = lons / 360.0 + 0.5
+        sin = np.clip(np.sin(np.radians(lats)), -0.9999, 0.9999)
+        y = 0.5 - 0.25 * np.log((1 + sin) / (1 - sin)) / math.pi
+        return x, np.clip(y, 0.0, 1.0)
+
+    def cluster(self, lats, lons):
+        """
+        Returns one flat [lat, lon, count, index, ...] list per zoom from
+        min_zoom to max_zoom, stopping before the first zoom where every
+        point is on its own. index is the point index for single points
+        and -1 for clusters.
+        """
+        if np is None:
+            raise ImportError("Pre-clustering requires numpy: pip install numpy")
+        
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        x, y = self.project(lats, lons)
+        
+        levels = []
+        for zoom in range(self.min_zoom, self.max_zoom + 1):
+            cells = 2 ** (zoom + self.cell_bits)
+            cx = np.minimum((x * cells).astype(np.int64), cells - 1)
+            cy = np.minimum((y * cells).astype(np.int64), cells - 1)
+            keys, first, inverse, counts = np.unique(
+                cy * cells + cx, return_index=True, return_inverse=True, return_counts=True
+            )
+            if len(keys) == len(lats):
+                # Cells only split further at deeper zooms
+                break
+            
+            lat = np.bincount(inverse, weights=lats) / counts
+            lon = np.bincount(inverse, weights=lons) / counts
+            index = np.where(counts == 1, first, -1)
+            
+            level = np.empty((len(keys), 4))
+            level[:, 0] = np.round(lat, 5)
+            level[:, 1] = np.round(lon, 5)
+            level[:, 2] = counts
+            level[:, 3] = index
+            levels.append([value if i % 4 < 2 else int(value)
+                           for i, value in enumerate(level.ravel().tolist())])
+        
+        return levels
+
+class Gazetteer:
+    """
+    Settlements from a GeoNames dump for reverse geocoding
+
+    load() parses a GeoNames country dump (e.g. UA.txt from
+    download.geonames.org/export/dump/), keeping populated places
+    (feature class P), with oblast names from admin1CodesASCII.txt when
+    given. The parsed table is cached as a flat binary next to the dump
+    and memory-mapped on later loads, so only the names that are looked
+    up get decoded. Nearest lookups use a scipy cKDTree over unit vectors
+    when scipy is installed and a GridIndex otherwise.
+    """
+
+    MAGIC = b'LUAMGAZ2'
+    HEADER = struct.Struct('<8sIIQq8s')
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, oblast_count, names_size, self.min_population, _ = self.HEADER.unpack_from(self._mmap)
+        if magic != self.MAGIC:
+            raise ValueError(f"Not a gazetteer cache: {path}")
+        
+        view = memoryview(self._mmap)
+        offset = self.HEADER.size
+        def take(typecode, length):
+            nonlocal offset
+            size = array(typecode).itemsize * length
+            part = view[offset:offset + size].cast(typecode)
+            offset += size
+            return part
+        
+        self.lats = take('d', count)
+        self.lons = take('d', count)
+        self.populations = take('q', count)
+        self.admin = take('H', count)
+        offset += -offset % 8
+        self._name_offsets = take('Q', count + 1)
+        self._names = view[offset:offset + names_size]
+        offset += names_size
+        self.oblasts = bytes(view[offset:]).decode('utf-8').split('\n') if oblast_count else []
+        
+        self.path = path
+        self._tree = None
+        self._grid = None
+        self._by_name = None
+
+    def __len__(self):
+        return len(self.lats)
+
+    @classmethod
+    def load(cls, dump, admin1=None, min_population=0):
+        """
+        Loads a GeoNames dump, through its binary cache (<dump>.gaz), which
+        is rebuilt when the dump, the admin1 file or min_population change
+        """
+        cache = dump + '.gaz'
+        fresh = os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(dump)
+        if fresh:
+            with open(cache, 'rb') as f:
+                header = f.read(cls.HEADER.size)
+            fresh = (len(header) == cls.HEADER.size and header[:8] == cls.MAGIC
+                     and cls.HEADER.unpack(header)[4:] == (min_population, cls._admin1_key(admin1)))
+        if not fresh:
+            cls.build(dump, cache, admin1, min_population)
+        return cls(cache)
+
+    @staticmethod
+    def _admin1_key(admin1):
+        """Identifies the admin1 file (path, size, mtime) a cache was built with"""
+        if not admin1:
+            return bytes(8)
+        st = os.stat(admin1)
+        identity = f"{os.path.abspath(admin1)}\0{st.st_size}\0{st.st_mtime_ns}"
+        return hashlib.blake2b(identity.encode('utf-8'), digest_size=8).digest()
+
+    @classmethod
+    def build(cls, dump, cache, admin1=None, min_population=0):
+        """Parses a GeoNames dump into the binary cache"""
+        oblast_names = {}
+        if admin1:
+            with open(admin1, encoding='utf-8') as f:
+                for line in f:
+                    parts = line.rstrip('\n').split('\t')
+                    if len(parts) >= 3:
+                        oblast_names[parts[0]] = parts[2]
+        
+        rows = []
+        with open(dump, encoding='utf-8') as f:
+            for line in f:
+                parts = line.rstrip('\n').split('\t')
+                if len(parts) < 15 or parts[6] != 'P':
+                    continue
+                population = int(parts[14] or 0)
+                if population < min_population:
+                    continue
+                rows.append((parts[1], float(parts[4]), float(parts[5]), population, f"{parts[8]}.{parts[10]}"))
+        
+        admin_codes = sorted({row[4] for row in rows})
+        admin_index = {code: i for i, code in enumerate(admin_codes)}
+        oblasts = [oblast_names.get(code, '') for code in admin_codes]
+        names = [row[0].encode('utf-8') for row in rows]
+        offsets = array('Q', [0])
+        for name in names:
+            offsets.append(offsets[-1] + len(name))
+        
+        body = [
+            array('d', [row[1] for row in rows]).tobytes(),
+            array('d', [row[2] for row in rows]).tobytes(),
+            array('q', [row[3] for row in rows]).tobytes(),
+            array('H', [admin_index[row[4]] for row in rows]).tobytes(),
+        ]
+        padding = -(cls.HEADER.size + sum(map(len, body))) % 8
+        with open(cache + '.tmp', 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, len(rows), len(oblasts), offsets[-1], min_population,
+                                    cls._admin1_key(admin1)))
+            for part in body:
+                f.write(part)
+            f.write(b'\0' * padding)
+            f.write(offsets.tobytes())
+            f.write(b''.join(names))
+            f.write('\n'.join(oblasts).encode('utf-8'))
+        os.replace(cache + '.tmp', cache)
+
+    def name(self, index):
+        return bytes(self._names[self._name_offsets[index]:self._name_offsets[index + 1]]).decode('utf-8')
+
+    def oblast(self, index):
+        return self.oblasts[self.admin[index]] if self.oblasts else ''
+
+    def find(self, name):
+        """Index of the most populous settlement with this name, or None"""
+        if self._by_name is None:
+            self._by_name = {}
+            for index in sorted(range(len(self)), key=lambda i: self.populations[i]):
+                self._by_name[self.name(index)] = index
+        return self._by_name.get(name)
+
+    def largest(self, count):
+        """{name: (lat, lon)} of the most populous settlements"""
+        cities = {}
+        for index in sorted(range(len(self)), key=lambda i: -self.populations[i]):
+            name = self.name(index)
+            if name not in cities:
+                cities[name] = (self.lats[index], self.lons[index])
+                if len(cities) == count:
+                    break
+        return cities
+
+    @staticmethod
+    def _unit_vectors(lats, lons):
+        lat = np.radians(np.asarray(lats, dtype=np.float64))
+        lon = np.radians(np.asarray(lons, dtype=np.float64))
+        return np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
+
+    def _index(self):
+        if self._tree is None and self._grid is None:
+            if cKDTree is not None and np is not None:
+                self._tree = cKDTree(self._unit_vectors(self.lats, self.lons))
+            else:
+                self._grid = GridIndex(cell_size=0.25)
+                for index in range(len(self)):
+                    self._grid.insert(self.lats[index], self.lons[index], index)
+
+    def nearest_many(self, lats, lons):
+        """
+        Indexes of and distances (km) to the nearest settlement for many
+        points at once
+        """
+        self._index()
+        if self._tree is not None:
+            chord, indexes = self._tree.query(self._unit_vectors(lats, lons), k=1, workers=-1)
+            return indexes, 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(chord / 2, 1.0))
+        indexes, distances = [], []
+        for lat, lon in zip(lats, lons):
+            distance, index = self._grid.nearest(lat, lon, 1)[0]
+            indexes.append(index)
+            distances.append(distance)
+        return indexes, distances
+
+    def nearest(self, lat, lon):
+        """Name of and distance (km) to the settlement nearest to a point"""
+        indexes, distances = self.nearest_many([lat], [lon])
+        return self.name(int(indexes[0])), float(distances[0])
+
+# Heat weight per event intensity
+INTENSITY_WEIGHTS = {'Low': 1.0, 'Medium': 2.0, 'High': 3.0}
+
+# Fill colours of density cells, lightest to densest
+DENSITY_COLORS = ['#ffffb2', '#fecc5c', '#fd8d3c', '#f03b20', '#bd0026']
+
+class DensityBinner:
+    """
+    Weighted event counts on a hexagonal or square grid
+
+    Points are projected to kilometres around the centre of the data
+    (equirectangular) and binned into cells cell_km across, so hexagons
+    stay regular at the map's latitudes. Binning and aggregation are
+    vectorized NumPy; only the cells are kept.
+    """
+
+    def __init__(self, cell_km=10.0, shape='hex'):
+        if shape not in ('hex', 'square'):
+            raise ValueError(f"Unknown cell shape: {shape}")
+        self.cell_km = cell_km
+        self.shape = shape
+
+    def bin(self, lats, lons, weights=None):
+        """
+        Returns cells as dicts with centre lat/lon, count, summed weight
+        and the polygon ([lat, lon] corners), densest first
+        """
+        if np is None:
+            raise ImportError("Density binning requires numpy: pip install numpy")
+        
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        weights = np.ones(len(lats)) if weights is None else np.asarray(weights, dtype=np.float64)
+        if not len(lats):
+            return []
+        
+        lat0 = (lats.min() + lats.max()) / 2
+        lon0 = (lons.min() + lons.max()) / 2
+        lon_km = KM_PER_DEGREE * math.cos(math.radians(lat0))
+        x = (lons - lon0) * lon_km
+        y = (lats - lat0) * KM_PER_DEGREE
+        
+        if self.shape == 'hex':
+            cells = self._hex_cells(x, y)
+        else:
+            cells = np.stack([np.floor(x / self.cell_km), np.floor(y / self.cell_km)], axis=1).astype(np.int64)
+        
+        keys, inverse, counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+        inverse = inverse.ravel()
+        totals = np.bincount(inverse, weights=weights)
+        cx, cy = self._centres(keys)
+        corners = self._corners()
+        
+        result = []
+        for i in np.argsort(-totals, kind='stable').tolist():
+            result.append({
+                'lat': round(lat0 + cy[i] / KM_PER_DEGREE, 5),
+                'lon': round(lon0 + cx[i] / lon_km, 5),
+                'count': int(counts[i]),
+                'weight': float(totals[i]),
+                'polygon': [[round(lat0 + (cy[i] + dy) / KM_PER_DEGREE, 5), round(lon0 + (cx[i] + dx) / lon_km, 5)]
+                            for dx, dy in corners],
+            })
+        return result
+
+    def _hex_cells(self, x, y):
+        """Axial (q, r) of pointy-top hexagons cell_km wide, by cube rounding"""
+        size = self.cell_km / math.sqrt(3)
+        q = (math.sqrt(3) / 3 * x - y / 3) / size
+        r = (2 / 3 * y) / size
+        s = -q - r
+        rq, rr, rs = np.round(q), np.round(r), np.round(s)
+        dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+        fix_q = (dq > dr) & (dq > ds)
+        fix_r = ~fix_q & (dr > ds)
+        rq = np.where(fix_q, -rr - rs, rq)
+        rr = np.where(fix_r, -rq - rs, rr)
+        return np.stack([rq, rr], axis=1).astype(np.int64)
+
+    def _centres(self, keys):
+        a, b = keys[:, 0].astype(np.float64), keys[:, 1].astype(np.float64)
+        if self.shape == 'hex':
+            size = self.cell_km / math.sqrt(3)
+            return size * math.sqrt(3) * (a + b / 2), size * 1.5 * b
+        return (a + 0.5) * self.cell_km, (b + 0.5) * self.cell_km
+
+    def _corners(self):
+        """Corner offsets (km) from a cell centre"""
+        if self.shape == 'hex':
+            size = self.cell_km / math.sqrt(3)
+            return [(size * math.cos(math.radians(30 + 60 * k)), size * math.sin(math.radians(30 + 60 * k)))
+                    for k in range(6)]
+        half = self.cell_km / 2
+        return [(-half, -half), (half, -half), (half, half), (-half, half)]
+
+# Ranks used when merging duplicate reports: the strongest value wins
+STATUS_RANK = {'Reported': 0, 'Verifying': 1, 'Confirmed': 2}
+INTENSITY_RANK = {'Low': 0, 'Medium': 1, 'High': 2}
+
+class EventDeduplicator:
+    """
+    Merges near-duplicate reports of one event
+
+    Reports of the same type within radius_km and minutes of a cluster's
+    first report join that cluster. Clusters are hashed by grid cell and
+    time bucket, so each report only checks the neighbouring cells of its
+    own and the previous bucket instead of every other report. A merged
+    event keeps the first report's fields with the combined source list,
+    the strongest status and intensity, and the number of reports.
+    """
+
+    def __init__(self, radius_km=0.5, minutes=15, same_type=True):
+        self.radius_km = radius_km
+        self.minutes = minutes
+        self.same_type = same_type
+        self.merged = 0
+
+    @staticmethod
+    def _minutes(event):
+        """Event time in minutes: epoch based if timestamped, else of the day"""
+        timestamp = event.get('timestamp')
+        if timestamp is not None:
+            return timestamp / 60.0
+        hour, minute = event['time'].split(':')
+        return int(hour) * 60 + int(minute)
+
+    def dedupe(self, events):
+        """Returns the events with duplicates merged, in input order"""
+        events = list(events)
+        times = [self._minutes(event) for event in events]
+        cell_deg = self.radius_km / KM_PER_DEGREE
+        cells = {}
+        clusters = []
+        
+        # In time order every candidate cluster started in this bucket or the one before
+        for i in sorted(range(len(events)), key=times.__getitem__):
+            event = events[i]
+            lat, lon = event['lat'], event['lon']
+            row, col = math.floor(lat / cell_deg), math.floor(lon / cell_deg)
+            bucket = math.floor(times[i] / self.minutes)
+            kind = event['type'] if self.same_type else None
+            # Cells get narrower than radius_km in longitude away from the equator
+            reach = math.ceil(1 / max(math.cos(math.radians(lat)), 0.01))
+            
+            best, best_km = None, None
+            for key_bucket in (bucket - 1, bucket):
+                for key_row in (row - 1, row, row + 1):
+                    for key_col in range(col - reach, col + reach + 1):
+                        for cluster in cells.get((kind, key_bucket, key_row, key_col), ()):
+                            first = events[cluster[0]]
+                            if times[i] - times[cluster[0]] > self.minutes:
+                                continue
+                            km = haversine_km(lat, lon, first['lat'], first['lon'])
+                            if km <= self.radius_km and (best_km is None or km < best_km):
+                                best, best_km = cluster, km
+            
+            if best is not None:
+                best.append(i)
+            else:
+                cluster = [i]
+                clusters.append(cluster)
+                cells.setdefault((kind, bucket, row, col), []).append(cluster)
+        
+        clusters.sort(key=lambda cluster: cluster[0])
+        self.merged = len(events) - len(clusters)
+        return [events[cluster[0]] if len(cluster) == 1 else self.merge([events[i] for i in sorted(cluster)])
+                for cluster in clusters]
+
+    @staticmethod
+    def merge(reports):
+        """One event from several reports of it"""
+        merged = dict(reports[0])
+        sources = [source.strip() for report in reports for source in report['source'].split(',')]
+        merged['source'] = ', '.join(dict.fromkeys(source for source in sources if source))
+        merged['status'] = max((report['status'] for report in reports), key=lambda s: STATUS_RANK.get(s, -1))
+        merged['intensity'] = max((report['intensity'] for report in reports),
+                                  key=lambda s: INTENSITY_RANK.get(s, -1))
+        merged['reports'] = sum(report.get('reports', 1) for report in reports)
+        return merged
+
+class StatisticsAccumulator:
+    """
+    Running event counts per type, city, status, image method and hour
+
+    Accumulators are updated event by event, can be merged across
+    partitions and serialized between builds, so a refresh only has to
+    count the new events. The statistics panel renders from snapshot().
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.types = Counter()
+        self.cities = Counter()
+        self.statuses = Counter()
+        self.image_methods = Counter()
+        self.hours = Counter()
+
+    def update(self, event):
+        """Counts one event"""
+        self.total += 1
+        self.types[event['type']] += 1
+        self.cities[event['city']] += 1
+        self.statuses[event['status']] += 1
+        self.image_methods[event['image_method']] += 1
+        self.hours[int(event['time'][:2])] += 1
+        return self
+
+    def remove(self, event):
+        """Uncounts an event that was counted before, e.g. a deleted report"""
+        self.total -= 1
+        for counter, key in ((self.types, event['type']), (self.cities, event['city']),
+                             (self.statuses, event['status']), (self.image_methods, event['image_method']),
+                             (self.hours, int(event['time'][:2]))):
+            counter[key] -= 1
+            if counter[key] <= 0:
+                del counter[key]
+        return self
+
+    def update_many(self, events):
+        """Counts an iterable of events"""
+        for event in events:
+            self.update(event)
+        return self
+
+    def merge(self, other):
+        """Adds the counts of another accumulator, e.g. from another partition"""
+        self.total += other.total
+        self.types.update(other.types)
+        self.cities.update(other.cities)
+        self.statuses.update(other.statuses)
+        self.image_methods.update(other.image_methods)
+        self.hours.update(other.hours)
+        return self
+
+    def snapshot(self):
+        """Returns a copy of the current counts as plain dicts"""
+        return {
+            'total': self.total,
+            'types': dict(self.types),
+            'cities': dict(self.cities),
+            'statuses': dict(self.statuses),
+            'image_methods': dict(self.image_methods),
+            'hours': dict(sorted(self.hours.items())),
+        }
+
+    def to_dict(self):
+        """JSON-serializable state, to keep counts between builds"""
+        state = self.snapshot()
+        state['hours'] = {str(hour): count for hour, count in state['hours'].items()}
+        return state
+
+    @classmethod
+    def from_dict(cls, state):
+        """Restores an accumulator saved with to_dict"""
+        stats = cls()
+        stats.total = state['total']
+        stats.types.update(state['types'])
+        stats.cities.update(state['cities'])
+        stats.statuses.update(state['statuses'])
+        stats.image_methods.update(state['image_methods'])
+        stats.hours.update({int(hour): count for hour, count in state['hours'].items()})
+        return stats
+
+class EventTable:
+    """
+    Columnar event set produced by the bulk generator
+
+    Coordinates, ids and times (minutes of the day) are NumPy arrays and
+    categorical fields are integer codes into shared category lists.
+    Iterating yields the same event dicts as generate_events_with_images.
+    """
+
+    CATEGORICAL = ('city', 'type', 'color', 'icon', 'source', 'image_url', 'intensity', 'status')
+
+    def __init__(self, columns, categories, image_method='local'):
+        self.columns = columns
+        self.categories = categories
+        self.image_method = image_method
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    def __iter__(self):
+        return self.iter_events()
+
+    def column(self, name):
+        """Returns a column with categorical codes decoded to their values"""
+        if name in self.CATEGORICAL:
+            return np.asarray(self.categories[name], dtype=object)[self.columns[name]]
+        return self.columns[name]
+
+    def iter_events(self, chunk_size=65536):
+        """Yields events in the dict shape used by the rest of the pipeline"""
+        for start in range(0, len(self), chunk_size):
+            stop = start + chunk_size
+            ids = self.columns['id'][start:stop].tolist()
+            lats = self.columns['lat'][start:stop].tolist()
+            lons = self.columns['lon'][start:stop].tolist()
+            minutes = self.columns['minute'][start:stop].tolist()
+            decoded = {
+                name: [self.categories[name][code] for code in self.columns[name][start:stop].tolist()]
+                for name in self.CATEGORICAL
+            }
+            
+            for i in range(len(ids)):
+                city = decoded['city'][i]
+                event_type = decoded['type'][i]
+                yield {
+                    'id': ids[i],
+                    'city': city,
+                    'lat': lats[i],
+                    'lon': lons[i],
+                    'type': event_type,
+                    'color': decoded['color'][i],
+                    'icon': decoded['icon'][i],
+                    'time': f"{minutes[i] // 60:02d}:{minutes[i] % 60:02d}",
+                    'description': DESCRIPTION_TEMPLATE.format(type=event_type, city=city),
+                    'source': decoded['source'][i],
+                    'image_url': decoded['image_url'][i],
+                    'image_method': self.image_method,
+                    'intensity': decoded['intensity'][i],
+                    'status': decoded['status'][i]
+                }
+
+class EventView(Mapping):
+    """
+    Read-only view of one EventStore row
+
+    Reads like the event dicts (event['city'], format_map, dict(view)),
+    fields are decoded from the store on access.
+    """
+
+    __slots__ = ('store', 'index')
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def __getitem__(self, name):
+        return self.store.value(self.index, name)
+
+    def __iter__(self):
+        return self.store.fields(self.index)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"EventView({dict(self)!r})"
+
+class EventStore:
+    """
+    Compact event storage without per-event dicts
+
+    Categorical fields are interned as small integer codes into shared
+    lookup tables; ids, coordinates, times (minutes of the day) and
+    timestamps are typed arrays. Descriptions are rendered from
+    DESCRIPTION_TEMPLATE on access unless an event brought its own.
+    Indexing and iteration yield EventView rows.
+    """
+
+    CATEGORICAL = EventTable.CATEGORICAL + ('image_method', 'oblast')
+    FIELDS = ('id', 'city', 'oblast', 'lat', 'lon', 'type', 'color', 'icon', 'time', 'timestamp',
+              'description', 'source', 'image_url', 'image_method', 'intensity', 'status')
+
+    def __init__(self):
+        self.ids = array('q')
+        self.lats = array('d')
+        self.lons = array('d')
+        self.minutes = array('H')
+        self.timestamps = array('d')  # NaN when the event has none
+        self.codes = {name: array('B') for name in self.CATEGORICAL}
+        self.categories = {name: [] for name in self.CATEGORICAL}
+        self._lookup = {name: {} for name in self.CATEGORICAL}
+        # Only descriptions that differ from the template, by row
+        self.descriptions = {}
+
+    def __len__(self):
+        return len(self.lats)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield EventView(self, index)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [EventView(self, i) for i in range(len(self))[index]]
+        return EventView(self, range(len(self))[index])
+
+    @classmethod
+    def from_events(cls, events):
+        """Builds a store from event dicts (or views)"""
+        return cls().extend(events)
+
+    @classmethod
+    def from_table(cls, table):
+        """Builds a store from an EventTable, column by column"""
+        store = cls()
+        columns = table.columns
+        count = len(table)
+        store.ids = array('q', columns['id'].astype(np.int64).tobytes())
+        store.lats = array('d', np.asarray(columns['lat'], dtype=np.float64).tobytes())
+        store.lons = array('d', np.asarray(columns['lon'], dtype=np.float64).tobytes())
+        store.minutes = array('H', columns['minute'].astype(np.uint16).tobytes())
+        store.timestamps = array('d', np.full(count, np.nan).tobytes())
+        
+        for name in EventTable.CATEGORICAL:
+            # Remap in case a category list repeats a value
+            lookup = {}
+            remap = np.array([lookup.setdefault(value, len(lookup)) for value in table.categories[name]])
+            typecode = store._code_type(len(lookup))
+            store.codes[name] = array(typecode, remap[columns[name]].astype(np.dtype(typecode)).tobytes())
+            store.categories[name] = list(lookup)
+            store._lookup[name] = lookup
+        
+        store.codes['image_method'] = array('B', bytes(count))
+        store.categories['image_method'] = [table.image_method]
+        store._lookup['image_method'] = {table.image_method: 0}
+        store.codes['oblast'] = array('B', bytes(count))
+        store.categories['oblast'] = [None]
+        store._lookup['oblast'] = {None: 0}
+        return store
+
+    @staticmethod
+    def _code_type(size):
+        """Smallest unsigned array type that can hold codes 0..size-1"""
+        for typecode in 'BHIQ':
+            if size <= 1 << 8 * array(typecode).itemsize:
+                return typecode
+        raise OverflowError(f"Too many categories: {size}")
+
+    def intern(self, name, value):
+        """Code of a categorical value, added to the lookup table if new"""
+        lookup = self._lookup[name]
+        code = lookup.get(value)
+        if code is None:
+            code = lookup[value] = len(lookup)
+            self.categories[name].append(value)
+            typecode = self._code_type(len(lookup))
+            if typecode != self.codes[name].typecode:
+                self.codes[name] = array(typecode, self.codes[name])
+        return code
+
+    def append(self, event):
+        """Adds one event, returns its row index"""
+        index = len(self)
+        event_id = event['id']
+        if isinstance(self.ids, array) and not (isinstance(event_id, int) and -1 << 63 <= event_id < 1 << 63):
+            # Feed ids may be strings
+            self.ids = list(self.ids)
+        self.ids.append(event_id)
+        self.lats.append(event['lat'])
+        self.lons.append(event['lon'])
+        hour, minute = event['time'].split(':')
+        self.minutes.append(int(hour) * 60 + int(minute))
+        timestamp = event.get('timestamp')
+        self.timestamps.append(math.nan if timestamp is None else timestamp)
+        
+        for name in self.CATEGORICAL:
+            # intern() may widen the code array, so look it up afterwards;
+            # only feed events carry an oblast (None when absent)
+            code = self.intern(name, event.get(name) if name == 'oblast' else event[name])
+            self.codes[name].append(code)
+        
+        description = event['description']
+        if description != DESCRIPTION_TEMPLATE.format(type=event['type'], city=event['city']):
+            self.descriptions[index] = description
+        return index
+
+    def extend(self, events):
+        """Adds an iterable of events"""
+        for event in events:
+            self.append(event)
+        return self
+
+    def value(self, index, name):
+        """One decoded field of a row"""
+        if name in self._lookup:
+            value = self.categories[name][self.codes[name][index]]
+            if value is None:
+                raise KeyError(name)
+            return value
+        if name == 'lat':
+            return self.lats[index]
+        if name == 'lon':
+            return self.lons[index]
+        if name == 'id':
+            return self.ids[index]
+        if name == 'time':
+            minute = self.minutes[index]
+            return f"{minute // 60:02d}:{minute % 60:02d}"
+        if name == 'description':
+            description = self.descriptions.get(index)
+            if description is None:
+                description = DESCRIPTION_TEMPLATE.format(type=self.value(index, 'type'), city=self.value(index, 'city'))
+            return description
+        if name == 'timestamp' and not math.isnan(self.timestamps[index]):
+            return self.timestamps[index]
+        raise KeyError(name)
+
+    def fields(self, index):
+        """Field names of a row; timestamp and oblast only if the event had them"""
+        skip = set()
+        if math.isnan(self.timestamps[index]):
+            skip.add('timestamp')
+        if self.categories['oblast'][self.codes['oblast'][index]] is None:
+            skip.add('oblast')
+        return (name for name in self.FIELDS if name not in skip)
+
+class FeedValidationError(ValueError):
+    """Raised for an invalid feed record when loading in strict mode"""
+
+# Marker color and icon per event type, as shown in the legend
+TYPE_STYLES = {
+    'Missile strike': ('red', 'flash'),
+    'Drone attack': ('purple', 'plane'),
+    'Artillery shelling': ('orange', 'fire'),
+    'Air raid alert': ('blue', 'warning-sign'),
+    'Infrastructure attack': ('green', 'home'),
+    'Other events': ('darkred', 'info-sign')
+}
+
+# Structural tokens of a JSON array; escapes are matched as a pair so an
+# escaped quote never toggles the string state
+ARRAY_TOKENS = re.compile(r'\\.|["\[\]{},]', re.S)
+
+class EventFeedLoader:
+    """
+    Streams events from NDJSON or JSON-array feeds (files, .gz files,
+    file objects or http(s) URLs)
+
+    The feed is read in chunks and parsed record by record, and each record
+    is validated and normalized into the event schema used by the popups,
+    so the raw feed is never held in memory. Invalid records are skipped
+    and counted, or raise FeedValidationError when strict=True. Records
+    without a city are reverse geocoded batch_size at a time, and events
+    get the oblast of the map's gazetteer when it has oblast names.
+    """
+
+    def __init__(self, map_obj, strict=False, chunk_size=1 << 16, max_record_size=1 << 24, batch_size=4096):
+        self.map_obj = map_obj
+        self.strict = strict
+        self.chunk_size = chunk_size
+        self.max_record_size = max_record_size
+        self.batch_size = batch_size
+        self.loaded = 0
+        self.skipped = 0
+        self._types = {ImageCatalog.slug(t): t for t in map_obj.event_types}
+
+    def iter_events(self, source):
+        """Yields normalized events from a feed"""
+        self.loaded = 0
+        self.skipped = 0
+        
+        batch = []
+        for index, record in enumerate(self.iter_records(source)):
+            try:
+                batch.append(self._parse(record, index))
+            except FeedValidationError:
+                if self.strict:
+                    raise
+                self.skipped += 1
+                continue
+            if len(batch) == self.batch_size:
+                self.loaded += len(batch)
+                yield from self._locate(batch)
+                batch = []
+        self.loaded += len(batch)
+        yield from self._locate(batch)
+        
+        if self.skipped:
+            self.map_obj.instrumentation.warn(f"⚠️ Skipped {self.skipped} invalid feed records")
+
+    def iter_records(self, source):
+        """Yields raw records, detecting NDJSON or a JSON array from the first character"""
+        chunks = self._iter_chunks(source)
+        buffer = ''
+        for chunk in chunks:
+            buffer += chunk
+            if buffer.strip():
+                break
+        
+        if buffer.lstrip().startswith('['):
+            yield from self._iter_array(buffer, chunks)
+        else:
+            yield from self._iter_lines(buffer, chunks)
+
+    def _iter_chunks(self, source):
+        """Yields decoded text chunks from a path, URL or file object"""
+        if hasattr(source, 'read'):
+            # Multibyte characters may be split across binary chunks
+            decoder = codecs.getincrementaldecoder('utf-8')()
+            while True:
+                chunk = source.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+            yield decoder.decode(b'', final=True)
+            return
+        
+        source = os.fspath(source)
+        if source.startswith(('http://', 'https://')):
+            decoder = codecs.getincrementaldecoder('utf-8')()
+            with requests.get(source, stream=True, timeout=30) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(self.chunk_size):
+                    yield decoder.decode(chunk)
+            yield decoder.decode(b'', final=True)
+            return
+        
+        opener = gzip.open if source.endswith('.gz') else open
+        with opener(source, 'rt', encoding='utf-8') as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    def _iter_lines(self, buffer, chunks):
+        oversized = False
+        while True:
+            *lines, buffer = buffer.split('\n')
+            for line in lines:
+                if oversized:
+                    # Rest of a line past max_record_size
+                    oversized = False
+                elif line.strip():
+                    yield self._decode(line)
+            if len(buffer) > self.max_record_size:
+                if self.strict:
+                    raise FeedValidationError(f"JSON line longer than {self.max_record_size} characters")
+                if not oversized:
+                    yield None
+                oversized = True
+                buffer = ''
+            chunk = next(chunks, None)
+            if chunk is None:
+                break
+            buffer += chunk
+        if buffer.strip() and not oversized:
+            yield self._decode(buffer)
+
+    def _decode(self, line):
+        try:
+            return json.loads(line)
+        except ValueError as e:
+            if self.strict:
+                raise FeedValidationError(f"Invalid JSON line: {e}")
+            return None
+
+    def _iter_array(self, buffer, chunks):
+        """Incremental parser for one large top-level JSON array"""
+        decoder = json.JSONDecoder()
+        pos = buffer.index('[') + 1
+        exhausted = False
+        
+        while True:
+            # Skip separators
+            while True:
+                while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                    pos += 1
+                if pos < len(buffer) or exhausted:
+                    break
+                buffer, pos = buffer[pos:], 0
+                chunk = next(chunks, None)
+                if chunk is None:
+                    exhausted = True
+                else:
+                    buffer += chunk
+            
+            if pos >= len(buffer):
+                raise FeedValidationError("Unterminated JSON array")
+            if buffer[pos] == ']':
+                return
+            
+            try:
+                record, end = decoder.raw_decode(buffer, pos)
+            except ValueError as e:
+                # A record whose end is in the buffer is malformed, otherwise
+                # it continues in the next chunk
+                end = self._element_end(buffer, pos)
+                if end is not None:
+                    if self.strict:
+                        raise FeedValidationError(f"Invalid JSON record: {e}")
+                    yield None
+                    pos = end
+                    continue
+                chunk = next(chunks, None)
+                if chunk is None or len(buffer) - pos > self.max_record_size:
+                    raise FeedValidationError(f"Invalid or truncated JSON record: {e}")
+                buffer, pos = buffer[pos:] + chunk, 0
+                continue
+            
+            yield record
+            pos = end
+
+    @staticmethod
+    def _element_end(buffer, pos):
+        """Index of the top-level ',' or ']' ending the array element at pos, or None"""
+        depth = 0
+        in_string = False
+        for match in ARRAY_TOKENS.finditer(buffer, pos):
+            token = match.group()
+            if in_string:
+                if token == '"':
+                    in_string = False
+            elif token == '"':
+                in_string = True
+            elif token in '[{':
+                depth += 1
+            elif token in ']}':
+                depth -= 1
+                if depth < 0:
+                    return match.start()
+            elif token == ',' and depth == 0:
+                return match.start()
+        return None
+
+    def normalize(self, record, index):
+        """Validates a raw record and maps it to the event schema"""
+        return self._locate([self._parse(record, index)])[0]
+
+    def _locate(self, events):
+        """
+        Fills in the city of city-less events and the oblasts with one
+        nearest_cities call, then the city-dependent image and description
+        """
+        gazetteer = self.map_obj.gazetteer
+        with_oblasts = gazetteer is not None and bool(gazetteer.oblasts)
+        pending = [event for event in events if event['city'] is None or (with_oblasts and not event['oblast'])]
+        if pending:
+            names, oblasts, _ = self.map_obj.nearest_cities(
+                [event['lat'] for event in pending], [event['lon'] for event in pending], oblasts=True
+            )
+            for event, name, oblast in zip(pending, names, oblasts):
+                if event['city'] is None:
+                    event['city'] = html.escape(name)
+                if not event['oblast']:
+                    event['oblast'] = html.escape(oblast)
+        
+        for event in events:
+            if event['image_url'] is None:
+                event['image_url'] = self.map_obj.get_local_image(event['city'], event['type'])
+            if event['description'] is None:
+                event['description'] = DESCRIPTION_TEMPLATE.format(type=event['type'], city=event['city'])
+        return events
+
+    def _parse(self, record, index):
+        """Validates a raw record; city, image and description may be left to _locate"""
+        if not isinstance(record, dict):
+            raise FeedValidationError(f"Record {index} is not an object")
+        
+        try:
+            lat = float(record.get('lat', record.get('latitude')))
+            lon = float(record.get('lon', record.get('lng', record.get('longitude'))))
+        except (TypeError, ValueError):
+            raise FeedValidationError(f"Record {index} has no valid coordinates")
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            raise FeedValidationError(f"Record {index} coordinates out of range: {lat}, {lon}")
+        
+        event_type = self._types.get(ImageCatalog.slug(record.get('type', '')), 'Other events')
+        default_color, default_icon = TYPE_STYLES.get(event_type, ('darkred', 'info-sign'))
+        color = record.get('color') if record.get('color') in self.map_obj.colors else default_color
+        icon = record.get('icon') if record.get('icon') in self.map_obj.icons else default_icon
+        
+        city = record.get('city')
+        city = html.escape(str(city)) if city else None
+        
+        timestamp = self._timestamp(record, index)
+        event_time = record.get('time')
+        if not (isinstance(event_time, str) and re.fullmatch(r'([01]\d|2[0-3]):[0-5]\d', event_time)):
+            event_time = datetime.fromtimestamp(timestamp).strftime('%H:%M')
+        
+        image_url = record.get('image_url')
+        if image_url:
+            image_url = html.escape(str(image_url))
+            image_method = html.escape(str(record.get('image_method', 'remote')))
+        else:
+            image_url = None
+            image_method = 'local'
+        
+        description = record.get('description')
+        description = html.escape(str(description)) if description else None
+        
+        return {
+            'id': self._id(record, index),
+            'city': city,
+            'oblast': html.escape(str(record.get('oblast') or '')),
+            'lat': lat,
+            'lon': lon,
+            'type': event_type,
+            'color': color,
+            'icon': icon,
+            'time': event_time,
+            'timestamp': timestamp,
+            'description': description,
+            'source': html.escape(str(record.get('source') or 'Unknown')),
+            'image_url': image_url,
+            'image_method': image_method,
+            'intensity': self._choice(record.get('intensity'), ('Low', 'Medium', 'High'), 'Medium'),
+            'status': self._choice(record.get('status'), ('Confirmed', 'Verifying', 'Reported'), 'Reported')
+        }
+
+    @staticmethod
+    def _id(record, index):
+        """Integer event id; popups format it with {id:03d}"""
+        value = record.get('id')
+        if value is None:
+            value = index
+        if isinstance(value, str) and re.fullmatch(r'\s*-?\d+\s*', value):
+            value = int(value)
+        elif isinstance(value, float) and value.is_integer():
+            value = int(value)
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise FeedValidationError(f"Record {index} has an invalid id: {value!r}")
+        return value
+
+    @staticmethod
+    def _choice(value, allowed, default):
+        value = str(value or '').strip().title()
+        return value if value in allowed else default
+
+    @staticmethod
+    def _timestamp(record, index):
+        """Event time as epoch seconds from an epoch number or ISO string"""
+        value = record.get('timestamp', record.get('datetime'))
+        if value is None:
+            return datetime.now().timestamp()
+        try:
+            if isinstance(value, (int, float)):
+                # Milliseconds are common in feeds
+                timestamp = value / 1000.0 if value > 1e11 else float(value)
+            else:
+                timestamp = datetime.fromisoformat(str(value).replace('Z', '+00:00')).timestamp()
+            # Out-of-range and NaN times fail here rather than in later stages
+            datetime.fromtimestamp(timestamp)
+        except (ValueError, OverflowError, OSError):
+            raise FeedValidationError(f"Record {index} has an invalid timestamp: {value}")
+        return timestamp
+
+class EventDatabase:
+    """
+    Persistent SQLite store of events across builds
+
+    Events are keyed by id (storing an id again replaces the event) and
+    indexed by timestamp, type, city, oblast and a spatial bucket
+    (cell_size degree grid cell), so filtered and historical maps only
+    read the rows they need. Descriptions equal to DESCRIPTION_TEMPLATE
+    are not stored.
+    """
+
+    CELL_SIZE = 0.1
+    COLUMNS = ('id', 'city', 'oblast', 'lat', 'lon', 'type', 'color', 'icon', 'time', 'timestamp',
+               'description', 'source', 'image_url', 'image_method', 'intensity', 'status')
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS events (
+            id UNIQUE NOT NULL,
+            city TEXT NOT NULL,
+            oblast TEXT NOT NULL DEFAULT '',
+            lat REAL NOT NULL,
+            lon REAL NOT NULL,
+            type TEXT NOT NULL,
+            color TEXT,
+            icon TEXT,
+            time TEXT NOT NULL,
+            timestamp REAL NOT NULL,
+            description TEXT,
+            source TEXT,
+            image_url TEXT,
+            image_method TEXT,
+            intensity TEXT,
+            status TEXT,
+            cell INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS events_timestamp ON events (timestamp);
+        CREATE INDEX IF NOT EXISTS events_type ON events (type, timestamp);
+        CREATE INDEX IF NOT EXISTS events_city ON events (city, timestamp);
+        CREATE INDEX IF NOT EXISTS events_oblast ON events (oblast, timestamp);
+        CREATE INDEX IF NOT EXISTS events_cell ON events (cell);
+    """
+
+    def __init__(self, path='events.db'):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(events)')]
+        if columns and 'oblast' not in columns:
+            # Databases from before oblasts were stored
+            self.connection.execute("ALTER TABLE events ADD COLUMN oblast TEXT NOT NULL DEFAULT ''")
+        self.connection.executescript(self.SCHEMA)
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM events').fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    @classmethod
+    def cell(cls, lat, lon):
+        """Spatial bucket of a point"""
+        return math.floor(lat / cls.CELL_SIZE) * 4000 + math.floor(lon / cls.CELL_SIZE) + 2000
+
+    def _row(self, event, now):
+        timestamp = event.get('timestamp')
+        description = event['description']
+        if description == DESCRIPTION_TEMPLATE.format(type=event['type'], city=event['city']):
+            description = None
+        return (
+            event['id'], event['city'], event.get('oblast', ''), event['lat'], event['lon'], event['type'],
+            event['color'], event['icon'], event['time'], now if timestamp is None else timestamp, description,
+            event['source'], event['image_url'], event['image_method'], event['intensity'],
+            event['status'], self.cell(event['lat'], event['lon'])
+        )
+
+    def insert_many(self, events, batch_size=10000):
+        """
+        Stores events in batched transactions; events without a timestamp
+        get the current time. Returns the number of events stored.
+        """
+        sql = f"INSERT OR REPLACE INTO events ({', '.join(self.COLUMNS)}, cell) VALUES ({', '.join('?' * (len(self.COLUMNS) + 1))})"
+        now = time.time()
+        total = 0
+        batch = []
+        for event in events:
+            batch.append(self._row(event, now))
+            if len(batch) >= batch_size:
+                with self.connection:
+                    self.connection.executemany(sql, batch)
+                total += len(batch)
+                batch = []
+        if batch:
+            with self.connection:
+                self.connection.executemany(sql, batch)
+            total += len(batch)
+        return total
+
+    def delete(self, ids):
+        """Removes events by id"""
+        with self.connection:
+            self.connection.executemany('DELETE FROM events WHERE id = ?', [(event_id,) for event_id in ids])
+
+    @staticmethod
+    def _epoch(value):
+        """Epoch seconds from a number, datetime or timedelta (that long ago)"""
+        if isinstance(value, timedelta):
+            return time.time() - value.total_seconds()
+        if isinstance(value, datetime):
+            return value.timestamp()
+        return float(value)
+
+    def _where(self, since=None, until=None, types=None, cities=None, bbox=None, oblasts=None):
+        clauses, params = [], []
+        if since is not None:
+            clauses.append('timestamp >= ?')
+            params.append(self._epoch(since))
+        if until is not None:
+            clauses.append('timestamp < ?')
+            params.append(self._epoch(until))
+        for column, values in (('type', types), ('city', cities), ('oblast', oblasts)):
+            if values is not None:
+                values = [values] if isinstance(values, str) else list(values)
+                clauses.append(f"{column} IN ({', '.join('?' * len(values))})")
+                params.extend(values)
+        if bbox is not None:
+            south, west, north, east = bbox
+            # One cell range per grid row, then the exact box
+            rows = range(math.floor(south / self.CELL_SIZE), math.floor(north / self.CELL_SIZE) + 1)
+            first, last = self.cell(0, west), self.cell(0, east)
+            if len(rows) <= 64:
+                clauses.append('(' + ' OR '.join(['cell BETWEEN ? AND ?'] * len(rows)) + ')')
+                for row in rows:
+                    params.extend((row * 4000 + first, row * 4000 + last))
+            clauses.append('lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?')
+            params.extend((south, north, west, east))
+        return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+    def query(self, since=None, until=None, types=None, cities=None, bbox=None, limit=None, oblasts=None):
+        """
+        Yields matching events as dicts, oldest first
+
+        since/until: epoch seconds, datetime, or timedelta meaning that
+        long ago (since=timedelta(hours=24) is the last 24 hours)
+        types/cities/oblasts: a value or a list of values
+        bbox: (south, west, north, east)
+        """
+        where, params = self._where(since, until, types, cities, bbox, oblasts)
+        sql = f"SELECT {', '.join(self.COLUMNS)} FROM events{where} ORDER BY timestamp"
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        
+        for row in self.connection.execute(sql, params):
+            event = dict(zip(self.COLUMNS, row))
+            if event['description'] is None:
+                event['description'] = DESCRIPTION_TEMPLATE.format(type=event['type'], city=event['city'])
+            yield event
+
+    def load(self, **filters):
+        """Matching events in a compact EventStore, see query() for filters"""
+        return EventStore.from_events(self.query(**filters))
+
+    def count(self, since=None, until=None, types=None, cities=None, bbox=None, oblasts=None):
+        where, params = self._where(since, until, types, cities, bbox, oblasts)
+        return self.connection.execute(f"SELECT COUNT(*) FROM events{where}", params).fetchone()[0]
+
+    def statistics(self, since=None, until=None, types=None, cities=None, bbox=None, oblasts=None):
+        """StatisticsAccumulator of the matching events, counted in SQL"""
+        where, params = self._where(since, until, types, cities, bbox, oblasts)
+        stats = StatisticsAccumulator()
+        for column, counter in (('type', stats.types), ('city', stats.cities), ('status', stats.statuses),
+                                ('image_method', stats.image_methods),
+                                ('CAST(substr(time, 1, 2) AS INTEGER)', stats.hours)):
+            for key, count in self.connection.execute(
+                    f"SELECT {column}, COUNT(*) FROM events{where} GROUP BY 1", params):
+                counter[key] = count
+        stats.total = sum(stats.types.values())
+        return stats
+
+class Instrumentation:
+    """
+    Stage timers, counters and optional cProfile capture for the pipeline
+
+    quiet=True silences the progress output of UkraineMapWithImages;
+    warnings still go to the logger. Metrics are exported with report()
+    or log_metrics(), or as JSON with UkraineMapWithImages.write_metrics().
+    """
+
+    def __init__(self, quiet=False, profile=False, logger=None):
+        self.quiet = quiet
+        self.profile = profile
+        self.logger = logger or logging.getLogger('liveuamap')
+        self.stages = {}
+        self.counters = Counter()
+        self.profiles = {}
+        self._depth = 0
+
+    def say(self, message):
+        """Progress output, dropped in quiet mode"""
+        if not self.quiet:
+            print(message)
+
+    def warn(self, message):
+        if self.quiet:
+            self.logger.warning(message)
+        else:
+            print(message)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    @contextmanager
+    def stage(self, name):
+        """Times a block as a pipeline stage; outermost stages can be profiled"""
+        profiler = None
+        if self.profile and self._depth == 0:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        
+        self._depth += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self._depth -= 1
+            stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0})
+            stage['calls'] += 1
+            stage['seconds'] += elapsed
+            self.logger.debug("stage %s took %.4fs", name, elapsed)
+            
+            if profiler is not None:
+                profiler.disable()
+                text = io.StringIO()
+                pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(25)
+                self.profiles[name] = text.getvalue()
+
+    def report(self):
+        """Metrics as a JSON-serializable dict"""
+        return {
+            'stages': {name: {'calls': stage['calls'], 'seconds': round(stage['seconds'], 6)}
+                       for name, stage in self.stages.items()},
+            'counters': dict(self.counters),
+        }
+
+    def log_metrics(self, level=logging.INFO):
+        for name, stage in self.stages.items():
+            self.logger.log(level, "stage=%s calls=%d seconds=%.4f", name, stage['calls'], stage['seconds'])
+        for name, value in self.counters.items():
+            self.logger.log(level, "counter=%s value=%d", name, value)
+
+def timed_stage(name):
+    """Times a UkraineMapWithImages method as a pipeline stage"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.instrumentation.stage(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+# Base layers; the map starts on one of them, add_layers adds the others
+BASE_LAYERS = {
+    'osm': {'tiles': 'OpenStreetMap'},
+    'satellite': {
+        'tiles': 'https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
+        'attr': 'Esri',
+        'name': '🛰️ Satellite',
+    },
+    'dark': {'tiles': 'cartodbdark_matter', 'name': '🌙 Dark'},
+}
+
 class UkraineMapWithImages:
     """
     Conflict map with images in marker popups
     """
     
-    def __init__(self):
+    def __init__(self, quiet=False, instrumentation=None, base='osm', gazetteer=None, city_count=50):
+        # Timers/counters for every stage; quiet drops progress output
+        self.instrumentation = instrumentation or Instrumentation(quiet=quiet)
+        
+        # Base layer shown on load, one of BASE_LAYERS
+        self.base = base
         self.map = folium.Map(
             location=[49.0, 32.0], 
             zoom_start=6,
-            tiles='OpenStreetMap'
+            tiles='OpenStreetMap' if base == 'osm' else None
         )
+        if base != 'osm':
+            folium.TileLayer(**BASE_LAYERS[base]).add_to(self.map)
         
         # Ukrainian cities
         self.cities = {
@@ -35,6 +2624,12 @@ class UkraineMapWithImages:
             'Avdiivka': (48.1372, 37.7544)
         }
         
+        # With a Gazetteer, events are generated around its city_count
+        # largest settlements and positions resolve to any settlement in it
+        self.gazetteer = gazetteer
+        if gazetteer is not None:
+            self.cities = gazetteer.largest(city_count)
+        
         # Safe Folium colors
         self.colors = ['red', 'blue', 'green', 'purple', 'orange', 'darkred']
         self.icons = ['flash', 'fire', 'plane', 'warning-sign', 'home', 'info-sign']
@@ -79,47 +2674,73 @@ class UkraineMapWithImages:
                 'https://war.ukraine.ua/imagebank-category/infrustrucure-destruction/?photo=51200'
             ]
         }
+        
+        # Images from the Pics folder, indexed once
+        self.image_catalog = ImageCatalog("Pics", self.instrumentation)
+        
+        # JS popup templates, added on first use of the template mode
+        self._event_runtime = None
+        
+        # Popup/tooltip HTML by event id, rendered once for many maps (VariantRenderer)
+        self.fragments = None
+        
+        # Set by add_layers
+        self.layer_control = None
+        
+        # Spatial indexes over the events on the map and the cities
+        self.event_index = GridIndex(cell_size=0.1)
+        self.city_index = GridIndex(cell_size=1.0)
+        for city_name, (lat, lon) in self.cities.items():
+            self.city_index.insert(lat, lon, city_name)
+        
+        # Above this many events the 'auto' render mode switches from
+        # per-marker folium objects to a bulk JS loader ('fast_cluster' or 'canvas')
+        self.bulk_threshold = 10000
+        self.bulk_engine = 'fast_cluster'
+    
+    def say(self, message):
+        """Progress output, silenced in quiet mode"""
+        self.instrumentation.say(message)
+    
+    def metrics(self):
+        """Stage timings and counters, including image cache hits"""
+        report = self.instrumentation.report()
+        report['counters']['image_cache_hits'] = self.image_catalog.hits
+        report['counters']['image_cache_misses'] = self.image_catalog.misses
+        return report
+    
+    def write_metrics(self, path):
+        """Writes metrics() as JSON, with cProfile summaries if profiling"""
+        report = self.metrics()
+        if self.instrumentation.profiles:
+            report['profiles'] = self.instrumentation.profiles
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        self.say(f"📊 Metrics: {path}")
     
     def get_local_image(self, city, event_type):
         """
         Gets local image from Pics folder
         """
         try:
-            import os
-            
-            # Check if Pics folder exists
-            pics_folder = "Pics"
-            if not os.path.exists(pics_folder):
-                print(f"⚠️ Pics folder not found, creating it...")
-                os.makedirs(pics_folder)
+            image_path = self.image_catalog.pick(city, event_type)
+            if image_path is None:
                 return f"https://picsum.photos/400/300?random={random.randint(1, 100)}"
-            
-            # Get list of available images (1.jpg to 10.jpg)
-            available_images = []
-            for i in range(1, 11):  # 1 to 10
-                image_path = os.path.join(pics_folder, f"{i}.jpg")
-                if os.path.exists(image_path):
-                    available_images.append(f"{i}.jpg")
-            
-            if not available_images:
-                print(f"⚠️ No images found in Pics folder")
-                return f"https://picsum.photos/400/300?random={random.randint(1, 100)}"
-            
-            # Select random image from available ones
-            selected_image = random.choice(available_images)
-            image_path = os.path.join(pics_folder, selected_image)
-            
-            # Convert backslashes to forward slashes for web compatibility
-            web_path = image_path.replace('\\', '/')
-            
-            print(f"📸 Using local image: {web_path}")
-            return web_path
+            return self.image_catalog.thumbnail(image_path)
             
         except Exception as e:
-            print(f"⚠️ Error getting local image: {e}")
+            self.instrumentation.warn(f"⚠️ Error getting local image: {e}")
             # Fallback - random image
             return f"https://picsum.photos/400/300?random={random.randint(1, 100)}"
     
+    @timed_stage('thumbnails')
+    def prepare_thumbnails(self, processes=None):
+        """
+        Resizes the Pics images to popup thumbnails; afterwards
+        get_local_image returns thumbnail paths
+        """
+        return ThumbnailPipeline(self.image_catalog, processes=processes).run()
+    
     def get_google_street_view_image(self, lat, lon):
         """
         Gets image from Google Street View API (DISABLED - using local images)
@@ -135,15 +2756,27 @@ class UkraineMapWithImages:
         # Always return local image instead
         return self.get_local_image(city, "")
     
+    @timed_stage('generate')
     def generate_events_with_images(self, count=60):
         """Generates events with assigned images"""
-        print(f"📍 Generating {count} events with images...")
+        self.say(f"📍 Generating {count} events with images...")
+        
+        events = list(self.iter_events_with_images(count))
+        
+        self.instrumentation.count('events', len(events))
+        self.say(f"✅ Generated {len(events)} events with images")
+        return events
+    
+    def iter_events_with_images(self, count=60):
+        """Yields random events one at a time, for streaming pipelines"""
+        city_names = list(self.cities.keys())
         
-        events = []
+        # Rescan Pics only if it changed since the last build
+        self.image_catalog.refresh()
         
         for i in range(count):
             # Choose random city
-            city_name = random.choice(list(self.cities.keys()))
+            city_name = random.choice(city_names)
             coords = self.cities[city_name]
             
             # Add small offset
@@ -172,7 +2805,7 @@ class UkraineMapWithImages:
                 'color': color,
                 'icon': icon,
                 'time': f"{hour:02d}:{minute:02d}",
-                'description': f"{event_type} in {city_name} area. Situation monitored by services.",
+                'description': DESCRIPTION_TEMPLATE.format(type=event_type, city=city_name),
                 'source': random.choice(['OSINT', 'Local Reports', 'Military Sources', 'News Agency']),
                 'image_url': image_url,
                 'image_method': image_method,
@@ -180,77 +2813,221 @@ class UkraineMapWithImages:
                 'status': random.choice(['Confirmed', 'Verifying', 'Reported'])
             }
             
-            events.append(event)
+            yield event
+    
+    @timed_stage('generate')
+    def generate_event_table(self, count=60, seed=None):
+        """
+        Generates events in bulk with NumPy, all fields drawn in batched
+        array operations from a seed. Returns an EventTable.
+        """
+        if np is None:
+            raise ImportError("Bulk generation requires numpy: pip install numpy")
         
-        print(f"✅ Generated {len(events)} events with images")
-        return events
+        self.say(f"📍 Generating {count} events (vectorized)...")
+        
+        rng = np.random.default_rng(seed)
+        city_names = list(self.cities.keys())
+        city_coords = np.array([self.cities[name] for name in city_names])
+        
+        city = rng.integers(0, len(city_names), count)
+        event_type = rng.integers(0, len(self.event_types), count)
+        
+        # City coordinates with small offset
+        lat = city_coords[city, 0] + rng.uniform(-0.05, 0.05, count)
+        lon = city_coords[city, 1] + rng.uniform(-0.05, 0.05, count)
+        
+        sources = ['OSINT', 'Local Reports', 'Military Sources', 'News Agency']
+        intensities = ['Low', 'Medium', 'High']
+        statuses = ['Confirmed', 'Verifying', 'Reported']
+        
+        columns = {
+            'id': np.arange(count, dtype=np.int64),
+            'lat': lat,
+            'lon': lon,
+            'minute': rng.integers(0, 24 * 60, count, dtype=np.int16),
+            'city': city,
+            'type': event_type,
+            'color': rng.integers(0, len(self.colors), count),
+            'icon': rng.integers(0, len(self.icons), count),
+            'source': rng.integers(0, len(sources), count),
+            'intensity': rng.integers(0, len(intensities), count),
+            'status': rng.integers(0, len(statuses), count),
+        }
+        
+        image_urls, columns['image_url'] = self._draw_images(rng, city, event_type, city_names)
+        
+        categories = {
+            'city': city_names,
+            'type': list(self.event_types),
+            'color': list(self.colors),
+            'icon': list(self.icons),
+            'source': sources,
+            'intensity': intensities,
+            'status': statuses,
+            'image_url': image_urls,
+        }
+        
+        self.instrumentation.count('events', count)
+        self.say(f"✅ Generated {count} events")
+        return EventTable(columns, categories)
     
-    def create_popup_with_image(self, event):
-        """Creates HTML popup with image"""
+    def generate_event_store(self, count=60, seed=None):
+        """
+        Generates events into a compact EventStore: in bulk with NumPy
+        when available, otherwise one event at a time
+        """
+        if np is not None:
+            return EventStore.from_table(self.generate_event_table(count, seed=seed))
         
-        # HTML popup with embedded image
-        popup_html = f"""
-        <div style="width: 420px; font-family: 'Segoe UI', Arial, sans-serif;">
-            
-            <!-- Header -->
-            <div style="background: linear-gradient(90deg, {event['color']} 0%, {event['color']}99 100%); 
-                        color: white; padding: 12px; margin: -10px -10px 15px -10px; 
-                        border-radius: 8px 8px 0 0;">
-                <h3 style="margin: 0; font-size: 16px; text-align: center;">
-                    🎯 {event['type']}
-                </h3>
-            </div>
-            
-            <!-- Image -->
-            <div style="text-align: center; margin: 15px 0;">
-                <img src="{event['image_url']}" 
-                     style="width: 100%; max-width: 380px; height: 200px; 
-                            object-fit: cover; border-radius: 8px; 
-                            border: 2px solid #ddd;"
-                     onerror="this.src='https://via.placeholder.com/380x200/cccccc/666666?text=Image+unavailable'"
-                     alt="Image from event location">
-                <div style="font-size: 10px; color: #888; margin-top: 5px;">
-                    Image source: {event['image_method']}
-                </div>
-            </div>
-            
-            <!-- Information -->
-            <div style="background: #f8f9fa; padding: 12px; border-radius: 6px; margin: 10px 0;">
-                <div style="display: grid; grid-template-columns: 1fr 1fr; gap: 8px; font-size: 12px;">
-                    <div><b>📍 City:</b> {event['city']}</div>
-                    <div><b>⏰ Time:</b> {event['time']}</div>
-                    <div><b>📊 Status:</b> {event['status']}</div>
-                    <div><b>🔥 Intensity:</b> {event['intensity']}</div>
-                </div>
-            </div>
-            
-            <!-- Description -->
-            <div style="margin: 12px 0; padding: 10px; background: #fff3cd; 
-                       border-left: 4px solid #ffc107; border-radius: 4px;">
-                <b>📝 Situation description:</b><br>
-                <span style="font-size: 13px;">{event['description']}</span>
-            </div>
-            
-            <!-- Source -->
-            <div style="margin: 12px 0; text-align: center; padding: 8px; 
-                       background: #e9ecef; border-radius: 4px; font-size: 11px;">
-                <b>📡 Information source:</b> {event['source']}<br>
-                <b>🆔 Event ID:</b> #{event['id']:03d}
-            </div>
-            
-            <!-- Coordinates -->
-            <div style="margin-top: 10px; font-size: 10px; color: #666; text-align: center;">
-                📐 Coordinates: {event['lat']:.4f}, {event['lon']:.4f}
-            </div>
-            
-        </div>
+        if seed is not None:
+            random.seed(seed)
+        with self.instrumentation.stage('generate'):
+            self.say(f"📍 Generating {count} events...")
+            store = EventStore.from_events(self.iter_events_with_images(count))
+            self.instrumentation.count('events', len(store))
+            self.say(f"✅ Generated {len(store)} events")
+        return store
+    
+    def _draw_images(self, rng, city, event_type, city_names):
+        """Draws an image per event from the catalog, one batch per city/type pair"""
+        catalog = self.image_catalog.refresh()
+        files = catalog.files
+        count = len(city)
+        
+        if not files:
+            fallback = [f"https://picsum.photos/400/300?random={i}" for i in range(1, 101)]
+            return fallback, rng.integers(0, len(fallback), count)
+        
+        # Without tags every event draws from all files
+        if not catalog.by_tag:
+            return [catalog.thumbnail(path) for path in files], rng.integers(0, len(files), count)
+        
+        file_index = {path: i for i, path in enumerate(files)}
+        codes = np.empty(count, dtype=np.int64)
+        
+        # Group event positions by city/type pair
+        pair = city * len(self.event_types) + event_type
+        order = np.argsort(pair, kind='stable')
+        pairs, starts = np.unique(pair[order], return_index=True)
+        bounds = list(starts[1:]) + [count]
+        
+        for value, start, stop in zip(pairs.tolist(), starts.tolist(), bounds):
+            city_name = city_names[value // len(self.event_types)]
+            type_name = self.event_types[value % len(self.event_types)]
+            pool = np.array([file_index[path] for path in catalog.candidates(city_name, type_name)])
+            codes[order[start:stop]] = pool[rng.integers(0, len(pool), stop - start)]
+        
+        return [catalog.thumbnail(path) for path in files], codes
+    
+    @timed_stage('dedup')
+    def deduplicate_events(self, events, radius_km=0.5, minutes=15, same_type=True):
+        """
+        Merges near-duplicate reports (see EventDeduplicator); run before
+        add_markers_with_images so markers, popups and statistics count
+        each event once
+        """
+        deduplicator = EventDeduplicator(radius_km, minutes, same_type)
+        events = deduplicator.dedupe(events)
+        self.instrumentation.count('duplicates_merged', deduplicator.merged)
+        self.say(f"🧹 Merged {deduplicator.merged} duplicate reports, {len(events)} events left")
+        return events
+    
+    @timed_stage('index')
+    def index_events(self, events):
+        """Adds events to the spatial index used by the query methods below"""
+        self.event_index.insert_events(events)
+    
+    def events_in_bbox(self, south, west, north, east):
+        """Indexed events inside a bounding box / viewport"""
+        return self.event_index.bbox(south, west, north, east)
+    
+    def events_near(self, lat, lon, radius_km):
+        """Indexed events within radius_km of a point, nearest first"""
+        return self.event_index.within_radius(lat, lon, radius_km)
+    
+    def events_near_city(self, city, radius_km):
+        """Indexed events within radius_km of a city, e.g. 20 km of Pokrovsk"""
+        if city in self.cities or self.gazetteer is None:
+            lat, lon = self.cities[city]
+        else:
+            index = self.gazetteer.find(city)
+            if index is None:
+                raise KeyError(city)
+            lat, lon = self.gazetteer.lats[index], self.gazetteer.lons[index]
+        return self.events_near(lat, lon, radius_km)
+    
+    def nearest_events(self, lat, lon, k=10):
+        """The k indexed events nearest to a point as (distance_km, event)"""
+        return self.event_index.nearest(lat, lon, k)
+    
+    def nearest_city(self, lat, lon):
+        """Name and distance (km) of the city nearest to a point"""
+        if self.gazetteer is not None:
+            return self.gazetteer.nearest(lat, lon)
+        distance, city = self.city_index.nearest(lat, lon, 1)[0]
+        return city, distance
+    
+    def nearest_cities(self, lats, lons, oblasts=False):
         """
-        
-        return popup_html
+        nearest_city for many points at once: lists of names and distances
+        (km), with the list of oblasts in between when oblasts=True ('' for
+        each point without a gazetteer)
+        """
+        if self.gazetteer is None:
+            pairs = [self.nearest_city(lat, lon) for lat, lon in zip(lats, lons)]
+            names, distances = [city for city, _ in pairs], [distance for _, distance in pairs]
+            return (names, [''] * len(names), distances) if oblasts else (names, distances)
+        indexes, distances = self.gazetteer.nearest_many(lats, lons)
+        indexes = [int(index) for index in indexes]
+        names = [self.gazetteer.name(index) for index in indexes]
+        if oblasts:
+            return names, [self.gazetteer.oblast(index) for index in indexes], list(distances)
+        return names, list(distances)
+    
+    def create_popup_with_image(self, event):
+        """Creates HTML popup with image"""
+        if self.fragments is not None and event['id'] in self.fragments:
+            return self.fragments[event['id']][0]
+        return POPUP_TEMPLATE.format_map(event)
     
-    def add_markers_with_images(self, events):
-        """Adds markers with images in popups"""
-        print(f"📌 Adding {len(events)} markers with images...")
+    def create_tooltip(self, event):
+        """Creates HTML tooltip with basic information"""
+        if self.fragments is not None and event['id'] in self.fragments:
+            return self.fragments[event['id']][1]
+        return TOOLTIP_TEMPLATE.format_map(event)
+    
+    def _ensure_event_runtime(self):
+        """Adds the JS popup/tooltip templates to the map once"""
+        if self._event_runtime is None:
+            self._event_runtime = EventRuntime()
+            self._event_runtime.add_to(self.map)
+        return self._event_runtime
+    
+    @timed_stage('markers')
+    def add_markers_with_images(self, events, render_mode='auto', filename="ukraine_map_with_images.html"):
+        """
+        Adds markers with images in popups
+        
+        render_mode:
+            'inline'       - popup HTML rendered in Python for every marker
+            'template'     - events written once as JSON, popups built in the browser
+            'fast_cluster' - template popups, markers created by a FastMarkerCluster callback
+            'canvas'       - template popups, canvas-rendered circle markers without clustering
+            'precluster'   - template popups, clusters per zoom computed in Python (ZoomClusterer),
+                             events in chunk files next to filename (add_preclustered_layers)
+            'density'      - no markers, intensity-weighted density layers (add_density_layers)
+            'auto'         - 'inline' up to self.bulk_threshold events, self.bulk_engine above
+        """
+        if render_mode == 'auto':
+            render_mode = 'inline' if len(events) <= self.bulk_threshold else self.bulk_engine
+        if render_mode not in ('inline', 'template', 'fast_cluster', 'canvas', 'precluster', 'density'):
+            raise ValueError(f"Unknown render mode: {render_mode}")
+        if render_mode == 'density':
+            return self.add_density_layers(events)
+        
+        self.say(f"📌 Adding {len(events)} markers with images...")
+        self.instrumentation.count('markers', len(events))
         
         # Group by type
         groups = {}
@@ -260,32 +3037,70 @@ class UkraineMapWithImages:
                 groups[event_type] = []
             groups[event_type].append(event)
         
+        if render_mode != 'inline':
+            self._ensure_event_runtime()
+        
+        if render_mode == 'fast_cluster':
+            # Rows go straight to one FastMarkerCluster per type
+            for event_type, event_list in groups.items():
+                plugins.FastMarkerCluster(
+                    [event_row(event) for event in event_list],
+                    callback=FAST_MARKER_CALLBACK,
+                    name=f"{event_type} ({len(event_list)})",
+                    options=CLUSTER_OPTIONS
+                ).add_to(self.map)
+            
+            self.say("✅ Markers with images added!")
+            return
+        
+        # Template and canvas modes: one JSON array ordered by group, each
+        # layer references its own slice
+        data = None
+        if render_mode in ('template', 'canvas'):
+            data = TemplatedEventData(
+                [event_row(event) for event_list in groups.values() for event in event_list]
+            )
+            data.add_to(self.map)
+        
+        if render_mode == 'canvas':
+            start = 0
+            for event_type, event_list in groups.items():
+                layer = folium.FeatureGroup(name=f"{event_type} ({len(event_list)})")
+                TemplatedMarkers(data, start, start + len(event_list), factory='circleMarker').add_to(layer)
+                start += len(event_list)
+                layer.add_to(self.map)
+            
+            self.say("✅ Markers with images added!")
+            return
+        
+        if render_mode == 'precluster':
+            self.add_preclustered_layers(groups, filename)
+            self.say("✅ Markers with images added!")
+            return
+        
         # Add groups to map
+        start = 0
         for event_type, event_list in groups.items():
             
             # Create group with clustering
             cluster = plugins.MarkerCluster(
                 name=f"{event_type} ({len(event_list)})",
-                options={
-                    'disableClusteringAtZoom': 10,  # Uncluster when zoomed in
-                    'maxClusterRadius': 50
-                }
+                options=CLUSTER_OPTIONS
             )
             
+            if data is not None:
+                TemplatedMarkers(data, start, start + len(event_list)).add_to(cluster)
+                start += len(event_list)
+                cluster.add_to(self.map)
+                continue
+            
             for event in event_list:
                 
                 # Create popup with image
                 popup_html = self.create_popup_with_image(event)
                 
                 # Tooltip with basic information
-                tooltip_text = f"""
-                <div style="font-size: 12px;">
-                    <b>{event['type']}</b><br>
-                    📍 {event['city']}<br>
-                    ⏰ {event['time']}<br>
-                    📊 {event['status']}
-                </div>
-                """
+                tooltip_text = self.create_tooltip(event)
                 
                 # Add marker
                 folium.Marker(
@@ -302,39 +3117,355 @@ class UkraineMapWithImages:
             # Add group to map
             cluster.add_to(self.map)
         
-        print("✅ Markers with images added!")
+        self.say("✅ Markers with images added!")
+    
+    @timed_stage('density')
+    def add_density_layers(self, events, cell_km=10.0, shape='hex', style='heatmap', types=None):
+        """
+        Adds pre-aggregated density layers weighted by intensity: one over
+        all events and one per type, toggled in the layer control. The page
+        carries only the cell aggregates.
+        
+        shape: 'hex' or 'square' cells, cell_km across
+        style:
+            'heatmap' - folium HeatMap over the cell centres
+            'cells'   - cell polygons coloured by weight, with count tooltips
+        types: event types that get their own layer; all if omitted
+        """
+        if style not in ('heatmap', 'cells'):
+            raise ValueError(f"Unknown density style: {style}")
+        
+        lats, lons, weights, event_types = self._density_columns(events)
+        if not len(lats):
+            return
+        self.say(f"🔥 Binning {len(lats)} events into {shape} cells of {cell_km:g} km...")
+        
+        binner = DensityBinner(cell_km, shape)
+        layers = [("🔥 Density: all events", np.ones(len(lats), dtype=bool), True)]
+        for event_type in (self.event_types if types is None else types):
+            mask = event_types == event_type
+            if mask.any():
+                layers.append((f"🔥 Density: {event_type} ({int(mask.sum())})", mask, False))
+        
+        cell_count = 0
+        for name, mask, show in layers:
+            cells = binner.bin(lats[mask], lons[mask], weights[mask])
+            cell_count += len(cells)
+            layer = folium.FeatureGroup(name=name, show=show)
+            if style == 'heatmap':
+                peak = max(cell['weight'] for cell in cells)
+                plugins.HeatMap(
+                    [[cell['lat'], cell['lon'], round(cell['weight'] / peak, 4)] for cell in cells],
+                    radius=25, blur=20, min_opacity=0.3
+                ).add_to(layer)
+            else:
+                self._density_cells(cells).add_to(layer)
+            layer.add_to(self.map)
+        
+        self.instrumentation.count('density_cells', cell_count)
+        self.say(f"✅ Density layers added ({cell_count} cells)")
     
-    def add_extended_statistics(self, events):
-        """Extended statistics with image information"""
+    def _density_columns(self, events):
+        """Coordinates, intensity weights and types as NumPy arrays"""
+        if np is None:
+            raise ImportError("Density layers require numpy: pip install numpy")
         
-        # Basic statistics
-        type_stats = {}
-        city_stats = {}
-        status_stats = {}
-        image_stats = {}
+        if isinstance(events, EventStore):
+            # Straight from the typed arrays and lookup tables
+            def decode(name, table):
+                codes = np.frombuffer(events.codes[name], dtype=np.dtype(events.codes[name].typecode))
+                return np.asarray(table, dtype=object)[codes]
+            weight_of = [INTENSITY_WEIGHTS.get(value, 1.0) for value in events.categories['intensity']]
+            return (np.frombuffer(events.lats), np.frombuffer(events.lons),
+                    decode('intensity', weight_of).astype(np.float64),
+                    decode('type', events.categories['type']))
         
+        lats, lons, weights, event_types = [], [], [], []
         for event in events:
-            # Types
-            event_type = event['type']
-            type_stats[event_type] = type_stats.get(event_type, 0) + 1
+            lats.append(event['lat'])
+            lons.append(event['lon'])
+            weights.append(INTENSITY_WEIGHTS.get(event['intensity'], 1.0))
+            event_types.append(event['type'])
+        return np.array(lats), np.array(lons), np.array(weights), np.array(event_types, dtype=object)
+    
+    @staticmethod
+    def _density_cells(cells):
+        """Cell polygons as GeoJSON, coloured in DENSITY_COLORS by weight"""
+        peak = max(cell['weight'] for cell in cells)
+        features = []
+        for cell in cells:
+            shade = min(int(cell['weight'] / peak * len(DENSITY_COLORS)), len(DENSITY_COLORS) - 1)
+            features.append({
+                'type': 'Feature',
+                'geometry': {
+                    'type': 'Polygon',
+                    'coordinates': [[[lon, lat] for lat, lon in cell['polygon'] + cell['polygon'][:1]]],
+                },
+                'properties': {'count': cell['count'], 'weight': cell['weight'], 'fill': DENSITY_COLORS[shade]},
+            })
+        
+        return folium.GeoJson(
+            {'type': 'FeatureCollection', 'features': features},
+            style_function=lambda feature: {
+                'fillColor': feature['properties']['fill'],
+                'fillOpacity': 0.6,
+                'color': '#bd0026',
+                'weight': 0.5,
+            },
+            tooltip=folium.GeoJsonTooltip(fields=['count', 'weight'], aliases=['Events', 'Weighted'])
+        )
+    
+    def add_preclustered_layers(self, groups, filename="ukraine_map_with_images.html", chunk_zoom=8):
+        """
+        Adds one layer per event type showing ZoomClusterer clusters; the
+        page only holds the cluster tree. Event rows are written as chunk
+        files per chunk_zoom tile (<page>.leaves/<layer>/<chunk>.js) and
+        loaded when a single event or the unclustered zoom needs them.
+        
+        groups: event lists by type
+        """
+        # Same zoom/radius behaviour as CLUSTER_OPTIONS, computed here
+        clusterer = ZoomClusterer(
+            radius=CLUSTER_OPTIONS['maxClusterRadius'],
+            max_zoom=CLUSTER_OPTIONS['disableClusteringAtZoom'] - 1
+        )
+        leaf_dir = os.path.splitext(filename)[0] + '.leaves'
+        scripts = []
+        for layer_index, (event_type, event_list) in enumerate(groups.items()):
+            # Leaves ordered by chunk, so a chunk is a contiguous range
+            tiles = {}
+            for event in event_list:
+                tiles.setdefault(self.tile_xy(event['lat'], event['lon'], chunk_zoom), []).append(event)
+            leaves = [event for events in tiles.values() for event in events]
+            levels = clusterer.cluster(
+                [event['lat'] for event in leaves],
+                [event['lon'] for event in leaves]
+            )
             
-            # Cities
-            city = event['city']
-            city_stats[city] = city_stats.get(city, 0) + 1
+            url = f"{os.path.basename(leaf_dir)}/{layer_index}"
+            for chunk, events in enumerate(tiles.values()):
+                rows = [event_row(event) for event in events]
+                scripts.append((f"{layer_index}/{chunk}",
+                                f"luam.leafChunk({json.dumps(url)}, {chunk}, {script_json(rows)});\n"))
             
-            # Status
-            status = event['status']
-            status_stats[status] = status_stats.get(status, 0) + 1
+            layer = folium.FeatureGroup(name=f"{event_type} ({len(event_list)})")
+            PreclusteredMarkers({
+                'url': url,
+                'levels': levels,
+                'minZoom': clusterer.min_zoom,
+                'maxZoom': clusterer.min_zoom + len(levels) - 1,
+                'chunkZoom': chunk_zoom,
+                'chunks': [[x, y, len(events)] for (x, y), events in tiles.items()],
+            }).add_to(layer)
+            layer.add_to(self.map)
+        
+        self._write_chunk_files(leaf_dir, scripts)
+        self.instrumentation.count('leaf_chunks', len(scripts))
+    
+    def _write_chunk_files(self, directory, scripts):
+        """
+        Replaces directory with the lazily loaded data files of a page: one
+        <name>.js per (name, code) of scripts; returns the bytes written
+        """
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+        written = 0
+        for name, code in scripts:
+            path = os.path.join(directory, *name.split('/')) + '.js'
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(code)
+            written += os.path.getsize(path)
+        self.instrumentation.count('bytes_written', written)
+        return written
+    
+    @staticmethod
+    def tile_xy(lat, lon, zoom):
+        """Slippy map (z/x/y) tile of a point"""
+        sin = min(max(math.sin(math.radians(lat)), -0.9999), 0.9999)
+        n = 2 ** zoom
+        x = min(int((lon + 180.0) / 360.0 * n), n - 1)
+        y = min(max(int((0.5 - math.log((1 + sin) / (1 - sin)) / (4 * math.pi)) * n), 0), n - 1)
+        return x, y
+    
+    @timed_stage('tiles')
+    def add_tiled_markers(self, events, filename="ukraine_map_with_images.html", levels=(5, 8), detail_zoom=11):
+        """
+        Adds the per-type layers with events served as z/x/y tile files
+        next to the page (<page>.tiles/z/x/y.js); the page only loads the
+        tiles in the viewport as it pans and zooms
+        
+        levels: zooms with aggregate tiles, each holding per-type counts on
+        an 8x8 grid inside the tile (single events as rows)
+        detail_zoom: from this zoom on, tiles hold the event rows shown in
+        each type's marker cluster
+        """
+        types = list(self.event_types)
+        groups = {}
+        detail = {}
+        aggregates = {}
+        for event in events:
+            event_type = event['type']
+            if event_type not in groups:
+                groups[event_type] = 0
+                if event_type not in types:
+                    types.append(event_type)
+            groups[event_type] += 1
+            type_index = types.index(event_type)
+            lat, lon = event['lat'], event['lon']
+            row = event_row(event)
             
-            # Image sources
-            method = event['image_method']
-            image_stats[method] = image_stats.get(method, 0) + 1
+            detail.setdefault((detail_zoom, *self.tile_xy(lat, lon, detail_zoom)), []).append(row)
+            for zoom in levels:
+                # 8x8 sub-cells per tile are the tiles three zooms deeper
+                sub_x, sub_y = self.tile_xy(lat, lon, zoom + 3)
+                cells = aggregates.setdefault((zoom, sub_x >> 3, sub_y >> 3), {})
+                cell = cells.get((type_index, sub_x, sub_y))
+                if cell is None:
+                    cells[(type_index, sub_x, sub_y)] = [1, lat, lon, row]
+                else:
+                    cell[0] += 1
+                    cell[1] += lat
+                    cell[2] += lon
+        
+        tile_dir = os.path.splitext(filename)[0] + '.tiles'
+        index = {}
+        scripts = []
+        payloads = [(key, {'rows': rows}) for key, rows in detail.items()]
+        payloads += [(key, {'clusters': [
+            [type_index, round(lat / count, 5), round(lon / count, 5), count] + ([row] if count == 1 else [])
+            for (type_index, _, _), (count, lat, lon, row) in cells.items()
+        ]}) for key, cells in aggregates.items()]
+        for (zoom, x, y), payload in payloads:
+            key = f"{zoom}/{x}/{y}"
+            scripts.append((key, f"luam.tile({json.dumps(key)}, {script_json(payload)});\n"))
+            index[key] = len(payload.get('rows') or payload['clusters'])
+        self._write_chunk_files(tile_dir, scripts)
+        self.instrumentation.count('tiles', len(index))
+        self.instrumentation.count('markers', sum(groups.values()))
+        
+        # Same per-type layers as add_markers_with_images, each with a
+        # cluster for the detail rows and room for aggregate markers
+        self._ensure_event_runtime()
+        layers = {}
+        for event_type, count in groups.items():
+            group = folium.FeatureGroup(name=f"{event_type} ({count})")
+            cluster = plugins.MarkerCluster(options=CLUSTER_OPTIONS, control=False).add_to(group)
+            group.add_to(self.map)
+            layers[event_type] = (group, cluster)
+        
+        TiledMarkers(layers, {
+            'url': os.path.basename(tile_dir),
+            'levels': sorted(levels),
+            'detail': detail_zoom,
+            'types': types,
+            'tiles': index,
+        }).add_to(self.map)
+        self.say(f"🧱 {len(index)} tiles for {sum(groups.values())} events in {tile_dir}")
+    
+    @timed_stage('build')
+    def create_map_tiled(self, events=None, filename="ukraine_map_with_images.html", levels=(5, 8),
+                         detail_zoom=11, count=60):
+        """Builds and saves a map whose events are loaded tile by tile"""
+        if events is None:
+            events = self.generate_events_with_images(count)
+        
+        self.index_events(events)
+        self.add_tiled_markers(events, filename, levels, detail_zoom)
+        self.add_extended_statistics(events)
+        self.add_legend_with_images()
+        self.add_layers()
+        self.save(filename)
+        return self.map
+    
+    @timed_stage('playback')
+    def add_playback_layer(self, events, filename="ukraine_map_with_images.html", bucket_minutes=60, window=1):
+        """
+        Adds a time playback layer: events are partitioned into time
+        buckets written as separate chunk files next to the page
+        (<page>.playback/<bucket>.js); the time slider loads only the
+        buckets inside its window, so opening a week costs one bucket.
+        
+        Buckets come from the event timestamp when present, otherwise
+        from the time of day. window: buckets shown at once.
+        """
+        bucket_seconds = bucket_minutes * 60
+        buckets = {}
+        kinds = set()
+        for event in events:
+            timestamp = event.get('timestamp')
+            if timestamp is None:
+                hour, minute = event['time'].split(':')
+                key = (int(hour) * 60 + int(minute)) // bucket_minutes
+            else:
+                key = int(timestamp // bucket_seconds)
+            kinds.add(timestamp is not None)
+            buckets.setdefault(key, []).append(event_row(event))
+        if len(kinds) > 1:
+            raise ValueError("Playback needs timestamps on all events or on none")
+        
+        chunk_dir = os.path.splitext(filename)[0] + '.playback'
+        self._write_chunk_files(chunk_dir, [
+            (str(key), f"luam.playbackChunk({key}, {script_json(rows)});\n") for key, rows in buckets.items()
+        ])
+        self.instrumentation.count('playback_buckets', len(buckets))
+        
+        self._ensure_event_runtime()
+        layer = folium.FeatureGroup(name=f"⏱️ Playback ({sum(len(rows) for rows in buckets.values())})")
+        TimePlayback({
+            'url': os.path.basename(chunk_dir),
+            'buckets': {key: len(rows) for key, rows in sorted(buckets.items())},
+            'first': min(buckets, default=0),
+            'last': max(buckets, default=0),
+            'window': window,
+            'bucketMinutes': bucket_minutes,
+            'epoch': True in kinds,
+        }).add_to(layer)
+        layer.add_to(self.map)
+        self.say(f"⏱️ Playback: {len(buckets)} buckets of {bucket_minutes} min in {chunk_dir}")
+    
+    @timed_stage('build')
+    def create_map_playback(self, events=None, filename="ukraine_map_with_images.html", bucket_minutes=60,
+                            window=1, count=60):
+        """Builds and saves a map whose events are played back over time"""
+        if events is None:
+            events = self.generate_events_with_images(count)
+        
+        self.index_events(events)
+        self.add_playback_layer(events, filename, bucket_minutes, window)
+        self.add_extended_statistics(events)
+        self.add_legend_with_images()
+        self.add_layers()
+        self.save(filename)
+        return self.map
+    
+    @timed_stage('statistics')
+    def add_extended_statistics(self, events=None, stats=None):
+        """
+        Extended statistics with image information
+        
+        stats: StatisticsAccumulator to update with events, e.g. counts kept
+        from previous builds; a new one is used if omitted. Returns it.
+        """
+        if stats is None:
+            stats = StatisticsAccumulator()
+        if events is not None:
+            stats.update_many(events)
+        
+        panel_html = self.create_statistics_panel(stats.snapshot())
+        self.map.get_root().html.add_child(folium.Element(panel_html))
+        return stats
+    
+    def create_statistics_panel(self, snapshot):
+        """Creates the statistics panel HTML from a StatisticsAccumulator snapshot"""
+        total = snapshot['total']
+        confirmed = snapshot['statuses'].get('Confirmed', 0)
         
         # Top 5 cities
-        top_cities = sorted(city_stats.items(), key=lambda x: x[1], reverse=True)[:5]
+        top_cities = heapq.nlargest(5, snapshot['cities'].items(), key=lambda x: x[1])
         
         # HTML panel
-        panel_html = f"""
+        parts = [f"""
         <div style="position: fixed; top: 10px; left: 10px; 
                     width: 320px; background: white; 
                     border: 2px solid #333; border-radius: 10px;
@@ -347,22 +3478,22 @@ class UkraineMapWithImages:
             
             <div style="display: grid; grid-template-columns: 1fr 1fr; gap: 8px; margin: 12px 0;">
                 <div style="text-align: center; padding: 10px; background: #f0f8ff; border-radius: 6px;">
-                    <div style="font-size: 20px; font-weight: bold; color: #0066cc;">{len(events)}</div>
+                    <div style="font-size: 20px; font-weight: bold; color: #0066cc;">{total}</div>
                     <div style="font-size: 10px;">Total events</div>
                 </div>
                 <div style="text-align: center; padding: 10px; background: #f0fff0; border-radius: 6px;">
-                    <div style="font-size: 20px; font-weight: bold; color: #228b22;">{len([e for e in events if e['status'] == 'Confirmed'])}</div>
+                    <div style="font-size: 20px; font-weight: bold; color: #228b22;">{confirmed}</div>
                     <div style="font-size: 10px;">Confirmed</div>
                 </div>
             </div>
             
             <h4 style="margin: 12px 0 5px 0; font-size: 13px;">🎯 Event types:</h4>
             <div style="max-height: 100px; overflow-y: auto; font-size: 11px;">
-        """
+        """]
         
-        for event_type, count in sorted(type_stats.items(), key=lambda x: x[1], reverse=True):
-            percent = (count / len(events) * 100) if len(events) > 0 else 0
-            panel_html += f"""
+        for event_type, count in sorted(snapshot['types'].items(), key=lambda x: x[1], reverse=True):
+            percent = (count / total * 100) if total > 0 else 0
+            parts.append(f"""
                 <div style="display: flex; justify-content: space-between; margin: 2px 0; align-items: center;">
                     <span>{event_type[:18]}...</span>
                     <div style="display: flex; align-items: center;">
@@ -372,39 +3503,39 @@ class UkraineMapWithImages:
                         <span style="font-weight: bold; font-size: 10px;">{count}</span>
                     </div>
                 </div>
-            """
+            """)
         
-        panel_html += """
+        parts.append("""
             </div>
             
             <h4 style="margin: 12px 0 5px 0; font-size: 13px;">🔥 Top locations:</h4>
             <div style="max-height: 80px; overflow-y: auto; font-size: 11px;">
-        """
+        """)
         
         for city, count in top_cities:
-            panel_html += f"""
+            parts.append(f"""
                 <div style="display: flex; justify-content: space-between; margin: 2px 0;">
                     <span>{city}</span>
                     <span style="font-weight: bold; color: #dc2626;">{count}</span>
                 </div>
-            """
+            """)
         
-        panel_html += f"""
+        parts.append(f"""
             </div>
             
             <h4 style="margin: 12px 0 5px 0; font-size: 13px;">📸 Image sources:</h4>
             <div style="font-size: 11px;">
-        """
+        """)
         
-        for method, count in image_stats.items():
-            panel_html += f"""
+        for method, count in snapshot['image_methods'].items():
+            parts.append(f"""
                 <div style="display: flex; justify-content: space-between; margin: 2px 0;">
                     <span>{method.title()}</span>
                     <span style="font-weight: bold; color: #059669;">{count}</span>
                 </div>
-            """
+            """)
         
-        panel_html += f"""
+        parts.append(f"""
             </div>
             
             <div style="margin-top: 15px; padding-top: 10px; border-top: 1px solid #ddd;
@@ -412,14 +3543,15 @@ class UkraineMapWithImages:
                 <div>💡 <b>Click marker to see image!</b></div>
                 <div style="margin-top: 5px;">
                     Updated: {datetime.now().strftime('%d.%m.%Y %H:%M')}<br>
-                    Images: Local Pics folder (1.jpg - 10.jpg)
+                    Images: Local Pics folder ({len(self.image_catalog)} files)
                 </div>
             </div>
         </div>
-        """
+        """)
         
-        self.map.get_root().html.add_child(folium.Element(panel_html))
+        return ''.join(parts)
     
+    @timed_stage('legend')
     def add_legend_with_images(self):
         """Legend with image information"""
         legend_html = """
@@ -443,7 +3575,7 @@ class UkraineMapWithImages:
             <div style="background: #fffbeb; padding: 8px; border-radius: 4px; border: 1px solid #fbbf24;">
                 <b>📸 Images in markers:</b><br>
                 • Local Pics folder<br>
-                • Images 1.jpg - 10.jpg<br>
+                • All images in Pics<br>
                 • Random selection<br>
                 <small style="color: #92400e;">Click marker to see!</small>
             </div>
@@ -457,83 +3589,933 @@ class UkraineMapWithImages:
         
         self.map.get_root().html.add_child(folium.Element(legend_html))
     
+    @timed_stage('layers')
     def add_layers(self):
         """Adds map layers"""
-        # Satellite
-        folium.TileLayer(
-            tiles='https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
-            attr='Esri',
-            name='🛰️ Satellite',
-            overlay=False,
-            control=True
-        ).add_to(self.map)
-        
-        # Dark
-        folium.TileLayer(
-            'cartodbdark_matter', 
-            name='🌙 Dark'
-        ).add_to(self.map)
+        # The other base layers (satellite, dark, ...)
+        for base, options in BASE_LAYERS.items():
+            if base != self.base:
+                folium.TileLayer(**options).add_to(self.map)
         
         # Layer control
-        folium.LayerControl().add_to(self.map)
+        self.layer_control = folium.LayerControl()
+        self.layer_control.add_to(self.map)
     
-    def create_map_with_images(self):
-        """Main function - creates map with images"""
-        print("🇺🇦 CREATING MAP WITH IMAGES")
-        print("=" * 35)
-        print("📸 Each marker will have an image!")
-        print("=" * 35)
+    @timed_stage('build')
+    def create_map_with_images(self, render_mode='auto', events=None, count=60, dedupe=False,
+                               filename="ukraine_map_with_images.html"):
+        """
+        Main function - creates map with images
+        
+        events: prepared events (list, EventTable, EventStore, ...); generated if omitted
+        filename: page the map will be saved as; chunk files of the
+        'precluster' mode are written next to it
+        dedupe: merge near-duplicate reports first; True for the default
+        thresholds or a dict of deduplicate_events arguments
+        """
+        self.say("🇺🇦 CREATING MAP WITH IMAGES")
+        self.say("=" * 35)
+        self.say("📸 Each marker will have an image!")
+        self.say("=" * 35)
         
         # 1. Generate events with images
-        events = self.generate_events_with_images(60)
+        if events is None:
+            events = self.generate_events_with_images(count)
+        if dedupe:
+            events = self.deduplicate_events(events, **(dedupe if isinstance(dedupe, dict) else {}))
         
-        # 2. Add everything to map
-        self.add_markers_with_images(events)
+        # 2. Index and add everything to map
+        self.index_events(events)
+        self.add_markers_with_images(events, render_mode=render_mode, filename=filename)
         self.add_extended_statistics(events)
         self.add_legend_with_images()
         self.add_layers()
         
-        print("✅ Map with images ready!")
+        self.say("✅ Map with images ready!")
         return self.map
     
+    @timed_stage('save')
     def save(self, filename="ukraine_map_with_images.html"):
         """Saves the map"""
         self.map.save(filename)
-        print(f"💾 Saved: {filename}")
+        self.instrumentation.count('bytes_written', os.path.getsize(filename))
+        self.say(f"💾 Saved: {filename}")
+    
+    @timed_stage('export')
+    def export_static(self, filename="ukraine_map_with_images.html", asset_dir='assets', compress=True):
+        """
+        Saves the map for static hosting: shared stylesheet, split
+        content-hashed JS, minified, with .gz/.br siblings (StaticExporter)
+        """
+        written = StaticExporter(self, asset_dir, compress).export(filename)
+        self.instrumentation.count('bytes_written', sum(os.path.getsize(path) for path in written))
+        self.say(f"📦 Exported: {filename} + {len(written) - 1} assets")
+        return written
+    
+    @timed_stage('save_streaming')
+    def save_streaming(self, filename="ukraine_map_with_images.html", events=None, count=60, chunk_size=1000,
+                       stats=None, delta=None):
+        """
+        Builds and saves the map in one pass without holding all events
+        
+        The map skeleton (layers, legend, runtime) is rendered first, then
+        events are written to the file in chunks of chunk_size as they are
+        produced, and the statistics panel and layer counts are filled in at
+        the end. events can be any iterable, e.g. a generator; peak memory
+        depends on chunk_size, not on the number of events.
+        
+        stats: StatisticsAccumulator filled while streaming
+        delta: DeltaPoller that keeps the saved page updated
+        """
+        if events is None:
+            events = self.iter_events_with_images(count)
+        
+        self.say(f"🌊 Streaming map to {filename}...")
+        
+        head, tail = self._streaming_skeleton([delta] if delta is not None else [])
+        if stats is None:
+            stats = StatisticsAccumulator()
+        
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write(head)
+            self._write_event_stream(f, events, stats, chunk_size)
+            f.write(tail)
+        
+        self.instrumentation.count('markers', stats.total)
+        self.instrumentation.count('bytes_written', os.path.getsize(filename))
+        self.say(f"💾 Saved: {filename} ({stats.total} events streamed)")
+        return filename
+    
+    def _streaming_skeleton(self, extras=()):
+        """
+        Renders the map around an empty event stream: one cluster per known
+        type, legend, layers and any extra elements. Returns (head, tail);
+        event chunks are written between the two.
+        """
+        self._ensure_event_runtime()
+        layers = {}
+        for event_type in self.event_types:
+            layers[event_type] = plugins.MarkerCluster(name=event_type, options=CLUSTER_OPTIONS)
+            layers[event_type].add_to(self.map)
+        self.add_legend_with_images()
+        self.add_layers()
+        for element in extras:
+            element.add_to(self.map)
+        
+        slot = EventStreamSlot(layers, self.layer_control, CLUSTER_OPTIONS)
+        slot.add_to(self.map)
+        head, _, tail = self.map.get_root().render().partition(slot.token)
+        return head, tail
+    
+    def _write_event_stream(self, f, events, stats, chunk_size=1000):
+        """Writes events as script chunks, then the panel and layer counts"""
+        chunk = []
+        for event in events:
+            chunk.append(event_row(event))
+            stats.update(event)
+            
+            if len(chunk) >= chunk_size:
+                f.write(f"luam.streamRows({script_json(chunk)});\n")
+                chunk = []
+        
+        if chunk:
+            f.write(f"luam.streamRows({script_json(chunk)});\n")
+        
+        panel_html = self.create_statistics_panel(stats.snapshot())
+        f.write(f"luam.finishStream({script_json(panel_html)});\n")
+    
+    @timed_stage('feed')
+    def create_map_from_feed(self, source, filename="ukraine_map_with_images.html", strict=False, chunk_size=1000):
+        """
+        Builds the map from a real event feed (NDJSON or JSON array, file
+        or URL) in one streaming pass: records are parsed, normalized,
+        counted for the statistics and written out without holding the feed
+        """
+        loader = EventFeedLoader(self, strict=strict)
+        self.say(f"📥 Loading events from {source}...")
+        self.save_streaming(filename, loader.iter_events(source), chunk_size=chunk_size)
+        self.instrumentation.count('events', loader.loaded)
+        self.say(f"✅ Loaded {loader.loaded} events ({loader.skipped} skipped)")
+        return loader
+    
+    @timed_stage('build')
+    def create_map_from_database(self, database, render_mode='auto', filename="ukraine_map_with_images.html",
+                                 **filters):
+        """
+        Builds the map from an EventDatabase, reading only the events that
+        match filters (see EventDatabase.query), e.g.
+        since=timedelta(hours=24), cities='Kharkiv'. Statistics are
+        counted in SQL. filename as in create_map_with_images.
+        """
+        self.say(f"🗄️ Loading events from {database.path}...")
+        with self.instrumentation.stage('query'):
+            events = database.load(**filters)
+            stats = database.statistics(**filters)
+        self.instrumentation.count('events', len(events))
+        self.say(f"✅ Loaded {len(events)} events")
+        
+        self.index_events(events)
+        self.add_markers_with_images(events, render_mode=render_mode, filename=filename)
+        self.add_extended_statistics(stats=stats)
+        self.add_legend_with_images()
+        self.add_layers()
+        return self.map
+    
+    @timed_stage('batch')
+    def render_variants(self, specs, events=None, output_dir='.', processes=None, count=60):
+        """
+        Renders map variants (see VariantRenderer for the spec format) of
+        one event set in parallel; returns per-variant timings
+        """
+        if events is None:
+            events = self.generate_events_with_images(count)
+        return VariantRenderer(self, events, output_dir, processes).run(specs)
+    
+    @timed_stage('incremental')
+    def create_map_incremental(self, events, filename="ukraine_map_with_images.html", complete=True,
+                               rebase_ratio=0.1, max_pending=2000, poll_minutes=15):
+        """
+        Incremental build for the 15-minute refresh cycle
+        
+        A manifest next to the page keeps a content hash and the statistics
+        fields per event id plus the running statistics. Only new or changed
+        events are rendered, into a small delta file that the open page polls
+        and applies, so a refresh costs O(churn) in output instead of
+        rewriting everything. Full rows go to an append-only sidecar that is
+        only read back on rebase.
+        
+        complete: events is the full current set, ids missing from it are
+        removed; with complete=False events only adds or updates
+        rebase_ratio, max_pending: the page is rebuilt from scratch once the
+        pending changes exceed this share of the live events or this count,
+        which bounds the delta file; with complete=False the other live
+        events are taken from the rows sidecar
+        
+        Returns a summary dict of what was written.
+        """
+        base_name = os.path.splitext(filename)[0]
+        manifest_path = base_name + '.manifest.json'
+        delta_path = base_name + '.delta.js'
+        rows_path = base_name + '.rows.jsonl'
+        
+        manifest = None
+        if all(os.path.exists(path) for path in (manifest_path, rows_path, filename)):
+            with open(manifest_path, encoding='utf-8') as f:
+                manifest = json.load(f)
+            # Older manifests have no rows sidecar to rebase from
+            if manifest.get('format') != 3:
+                manifest = None
+        
+        if manifest is not None:
+            pending = sum(len(c['upsert']) + len(c['remove']) for c in manifest['changesets'])
+            if pending > min(rebase_ratio * max(len(manifest['events']), 1), max_pending):
+                if not complete:
+                    events = list(events)
+                    ids = {str(event['id']) for event in events}
+                    events += [dict(zip(EVENT_FIELDS, row)) for key, row in self._read_rows(rows_path).items()
+                               if key not in ids]
+                manifest = None
+        
+        # Full build: stream every event into a fresh page
+        if manifest is None:
+            entries = {}
+            stats = StatisticsAccumulator()
+            base = hashlib.sha1(f"{filename}:{datetime.now().isoformat()}".encode()).hexdigest()[:12]
+            
+            with open(rows_path, 'w', encoding='utf-8') as rows_file:
+                def tracked(events):
+                    for event in events:
+                        key = str(event['id'])
+                        row = event_row(event)
+                        entries[key] = self._manifest_entry(event, row)
+                        rows_file.write(script_json([key, row]) + '\n')
+                        yield event
+                
+                self.save_streaming(
+                    filename, tracked(events), stats=stats,
+                    delta=DeltaPoller(os.path.basename(delta_path), base, poll_minutes)
+                )
+            manifest = {'format': 3, 'base': base, 'version': 0, 'events': entries,
+                        'stats': stats.to_dict(), 'changesets': []}
+            self._write_incremental(manifest, manifest_path, delta_path, stats)
+            return {'mode': 'full', 'events': len(entries), 'version': 0}
+        
+        # Delta build: diff against the manifest
+        entries = manifest['events']
+        stats = StatisticsAccumulator.from_dict(manifest['stats'])
+        upsert = []
+        seen = set()
+        
+        for event in events:
+            key = str(event['id'])
+            seen.add(key)
+            row = event_row(event)
+            entry = self._manifest_entry(event, row)
+            old = entries.get(key)
+            if old is not None and old[0] == entry[0]:
+                continue
+            if old is not None:
+                stats.remove(self._entry_event(old))
+            stats.update(event)
+            entries[key] = entry
+            upsert.append(row)
+        
+        remove = []
+        if complete:
+            for key in [key for key in entries if key not in seen]:
+                stats.remove(self._entry_event(entries.pop(key)))
+                remove.append(key)
+        
+        if upsert or remove:
+            manifest['version'] += 1
+            manifest['changesets'].append({'version': manifest['version'], 'upsert': upsert, 'remove': remove})
+            manifest['stats'] = stats.to_dict()
+            with open(rows_path, 'a', encoding='utf-8') as f:
+                for row in upsert:
+                    f.write(script_json([str(row[2]), row]) + '\n')
+                for key in remove:
+                    f.write(script_json([key, None]) + '\n')
+            self._write_incremental(manifest, manifest_path, delta_path, stats)
+        
+        self.say(f"🔁 Delta v{manifest['version']}: {len(upsert)} new/changed, {len(remove)} removed")
+        return {'mode': 'delta', 'upserted': len(upsert), 'removed': len(remove), 'version': manifest['version']}
+    
+    MANIFEST_FIELDS = ('type', 'city', 'status', 'image_method', 'time')
+    
+    @classmethod
+    def _manifest_entry(cls, event, row):
+        """Content hash plus the fields needed to uncount the event later"""
+        digest = hashlib.sha1(script_json(row).encode('utf-8')).hexdigest()[:16]
+        return [digest] + [event[field] for field in cls.MANIFEST_FIELDS]
+    
+    @classmethod
+    def _entry_event(cls, entry):
+        return dict(zip(cls.MANIFEST_FIELDS, entry[1:]))
+    
+    @staticmethod
+    def _read_rows(rows_path):
+        """Replay the rows sidecar, later lines win and a null row is a removal"""
+        rows = {}
+        with open(rows_path, encoding='utf-8') as f:
+            for line in f:
+                key, row = json.loads(line)
+                if row is None:
+                    rows.pop(key, None)
+                else:
+                    rows[key] = row
+        return rows
+    
+    def _write_incremental(self, manifest, manifest_path, delta_path, stats):
+        delta = {
+            'base': manifest['base'],
+            'changesets': manifest['changesets'],
+            'panel': self.create_statistics_panel(stats.snapshot()),
+        }
+        with open(delta_path, 'w', encoding='utf-8') as f:
+            f.write(f"luam.applyDelta({script_json(delta)});\n")
+        self.instrumentation.count('bytes_written', os.path.getsize(delta_path))
+        with open(manifest_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, separators=(',', ':'))
+
+# ============================================================================
+# LIVE SERVER
+# ============================================================================
+
+class LocalEventSource:
+    """
+    In-process source of event batches for LiveMapServer, for tests and
+    demos: push() batches from the same event loop, close() to finish
+    """
+    
+    def __init__(self):
+        self._queue = asyncio.Queue()
+    
+    def push(self, events):
+        self._queue.put_nowait(list(events))
+    
+    def close(self):
+        self._queue.put_nowait(None)
+    
+    async def __aiter__(self):
+        while True:
+            batch = await self._queue.get()
+            if batch is None:
+                return
+            yield batch
+
+class LiveMapServer:
+    """
+    Local asyncio HTTP server for a live map
+    
+    The page is rendered once; newly published events and the updated
+    statistics panel are serialized once per batch and pushed to every
+    connected browser over Server-Sent Events. Viewers that fall
+    queue_size messages behind are dropped and catch up on reconnect
+    from the backlog (Last-Event-ID). The backlog keeps the last
+    backlog_size batches; when it is full the older half is folded into
+    the page, and new viewers only replay what came after their page.
+    
+    Routes: / (map), /events (SSE stream), /Pics/... (images)
+    """
+    
+    def __init__(self, map_obj, host='127.0.0.1', port=8765, queue_size=256, keepalive=15, backlog_size=1024):
+        self.map_obj = map_obj
+        self.host = host
+        self.port = port
+        self.queue_size = queue_size
+        self.keepalive = keepalive
+        self.stats = StatisticsAccumulator()
+        self.page = b''
+        self.page_sequence = 0
+        self.backlog = deque(maxlen=backlog_size)
+        self.stats_message = b''
+        self.clients = set()
+        self.server = None
+        self._sequence = 0
+        self._page_parts = None
+    
+    def build_page(self, events=()):
+        """Renders the page once, with the initial events"""
+        buffer = io.StringIO()
+        head, tail = self.map_obj._streaming_skeleton([LiveUpdates('/events')])
+        self.map_obj._write_event_stream(buffer, events, self.stats)
+        # The event stream ends with the finishStream call
+        body, _, _ = buffer.getvalue().rpartition('luam.finishStream(')
+        self._page_parts = (head, [body], tail)
+        self.backlog.clear()
+        self._render_page()
+    
+    def _render_page(self):
+        """Joins the page from its parts, with the current panel and sequence"""
+        head, body, tail = self._page_parts
+        panel_html = self.map_obj.create_statistics_panel(self.stats.snapshot())
+        self.page = ''.join([
+            head, *body,
+            f"luam.liveSequence = {self.page_sequence};\n",
+            f"luam.finishStream({script_json(panel_html)});\n",
+            tail
+        ]).encode('utf-8')
+    
+    def _fold_backlog(self):
+        """Moves the older half of the backlog into the page"""
+        _, body, _ = self._page_parts
+        for _ in range(max(1, len(self.backlog) // 2)):
+            sequence, _, rows = self.backlog.popleft()
+            body.append(f"luam.liveRows({script_json(rows)});\n")
+            self.page_sequence = sequence
+        self._render_page()
+    
+    def publish(self, events):
+        """Pushes new events and the updated statistics to every viewer"""
+        events = list(events)
+        if not events:
+            return 0
+        
+        self.stats.update_many(events)
+        self._sequence += 1
+        rows = [event_row(event) for event in events]
+        message = self._message('events', rows, self._sequence)
+        self.stats_message = self._message('stats', self.map_obj.create_statistics_panel(self.stats.snapshot()))
+        if len(self.backlog) == self.backlog.maxlen:
+            self._fold_backlog()
+        self.backlog.append((self._sequence, message, rows))
+        
+        for queue in list(self.clients):
+            try:
+                queue.put_nowait(message + self.stats_message)
+            except asyncio.QueueFull:
+                # Too slow: dropped now, replays the backlog on reconnect
+                self.clients.discard(queue)
+        return len(events)
+    
+    @staticmethod
+    def _message(event, data, sequence=None):
+        """Encodes one SSE message"""
+        head = f"id: {sequence}\n" if sequence is not None else ""
+        return f"{head}event: {event}\ndata: {json.dumps(data, ensure_ascii=False, separators=(',', ':'))}\n\n".encode('utf-8')
+    
+    async def start(self):
+        """Renders the page if needed and starts listening"""
+        if not self.page:
+            self.build_page()
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.map_obj.say(f"📡 Live map: http://{self.host}:{self.port}/")
+        return self
+    
+    async def consume(self, source):
+        """Publishes every batch of an async event source"""
+        async for batch in source:
+            self.publish(batch)
+    
+    async def serve_forever(self, source=None):
+        """Runs the server, publishing from source if one is given"""
+        await self.start()
+        try:
+            if source is not None:
+                await self.consume(source)
+            await self.server.serve_forever()
+        finally:
+            await self.close()
+    
+    async def close(self):
+        """Stops listening and disconnects every viewer"""
+        if self.server is None:
+            return
+        self.server.close()
+        for queue in list(self.clients):
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(None)
+        self.clients.clear()
+        await self.server.wait_closed()
+        self.server = None
+    
+    async def _handle(self, reader, writer):
+        try:
+            request = await reader.readuntil(b'\r\n\r\n')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            writer.close()
+            return
+        
+        lines = request.decode('latin-1').split('\r\n')
+        method, path = (lines[0].split(' ') + ['', ''])[:2]
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        path, _, query = path.partition('?')
+        
+        try:
+            if method != 'GET':
+                await self._respond(writer, 405, b'Method not allowed')
+            elif path in ('/', '/index.html'):
+                await self._respond(writer, 200, self.page, 'text/html; charset=utf-8')
+            elif path == '/events':
+                await self._stream(writer, headers, query)
+            else:
+                await self._static(writer, path)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+    
+    async def _respond(self, writer, status, body, content_type='text/plain; charset=utf-8', extra=''):
+        reason = {200: 'OK', 404: 'Not Found', 405: 'Method Not Allowed'}.get(status, '')
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(body)}\r\n{extra}Connection: close\r\n\r\n".encode('latin-1'))
+        writer.write(body)
+        await writer.drain()
+    
+    async def _static(self, writer, path):
+        """Serves files from the image folder only"""
+        folder = os.path.realpath(self.map_obj.image_catalog.folder)
+        target = os.path.realpath(os.path.join(os.path.dirname(folder), path.lstrip('/')))
+        if not target.startswith(folder + os.sep) or not os.path.isfile(target):
+            await self._respond(writer, 404, b'Not found')
+            return
+        
+        loop = asyncio.get_running_loop()
+        with open(target, 'rb') as f:
+            body = await loop.run_in_executor(None, f.read)
+        content_type = mimetypes.guess_type(target)[0] or 'application/octet-stream'
+        await self._respond(writer, 200, body, content_type, 'Cache-Control: max-age=86400\r\n')
+    
+    async def _stream(self, writer, headers, query=''):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                     b"Cache-Control: no-cache\r\nConnection: keep-alive\r\n\r\n")
+        
+        # Catch up on what was published since the viewer's page (?after=)
+        # or last received message (Last-Event-ID on reconnect)
+        after = re.search(r'(?:^|&)after=(\d+)', query)
+        try:
+            last_seen = int(headers.get('last-event-id') or (after.group(1) if after else 0))
+        except ValueError:
+            last_seen = 0
+        if last_seen < self.page_sequence:
+            # Part of what was missed is only in the page now
+            writer.write(b"event: reload\ndata: {}\n\n")
+            await writer.drain()
+            return
+        for sequence, message, _ in self.backlog:
+            if sequence > last_seen:
+                writer.write(message)
+        writer.write(self.stats_message)
+        
+        queue = asyncio.Queue(self.queue_size)
+        self.clients.add(queue)
+        try:
+            await writer.drain()
+            while queue in self.clients:
+                try:
+                    message = await asyncio.wait_for(queue.get(), self.keepalive)
+                except asyncio.TimeoutError:
+                    message = b': keepalive\n\n'
+                if message is None:
+                    break
+                writer.write(message)
+                await writer.drain()
+        finally:
+            self.clients.discard(queue)
+
+# ============================================================================
+# STATIC EXPORT
+# ============================================================================
+
+def minify_code(text):
+    """
+    Whitespace-only minifier for HTML, JS and CSS: drops indentation and
+    blank lines but keeps line breaks, so JS semicolon insertion and
+    string contents other than indentation are left alone
+    """
+    return '\n'.join(line.strip() for line in text.splitlines() if line.strip()) + '\n'
+
+class StaticExporter:
+    """
+    Writes a map as a small HTML page plus content-hashed assets
+
+    - repeated inline style="..." attributes become classes of one shared
+      stylesheet (declarations marked !important, as inline styles win
+      over stylesheets)
+    - the popup runtime (code), event data and the map script are split
+      into separate JS files loaded in the original order
+    - everything is minified, and .gz (and .br with the brotli package)
+      siblings are written next to each file
+
+    Asset names carry a hash of their content, so the server can send them
+    with long cache lifetimes (Cache-Control: immutable).
+    """
+
+    STYLE_ATTRIBUTE = re.compile(r'''(<[a-zA-Z][\w-]*(?:\s[^<>]*?)?)\sstyle="([^"]*)"([^<>]*>)''')
+    CLASS_ATTRIBUTE = re.compile(r'\sclass="([^"]*)"')
+    INLINE_SCRIPT = re.compile(r'<script>(.*?)</script>', re.S)
+    # Where the runtime/data scripts were cut from the map script
+    SPLIT_TOKEN = '/*__LUAM_ASSETS__*/'
+
+    def __init__(self, map_obj, asset_dir='assets', compress=True, min_inline=1024):
+        self.map_obj = map_obj
+        self.asset_dir = asset_dir
+        self.compress = compress
+        # Scripts shorter than this stay in the page
+        self.min_inline = min_inline
+        self.written = []
+
+    def export(self, filename):
+        """Writes the page and its assets; returns the written paths"""
+        root = self.map_obj.map.get_root()
+        page = root.render()
+        self.output_dir = os.path.dirname(os.path.abspath(filename))
+        
+        # Runtime and data scripts, cut out of the map script
+        pieces = []
+        for element in self._split_elements():
+            text = root.script._children[element.get_name()].render()
+            if text in page:
+                page = page.replace(text, '' if pieces else self.SPLIT_TOKEN, 1)
+                name = 'runtime' if isinstance(element, EventRuntime) else 'data'
+                pieces.append(self._asset(name, 'js', minify_code(text)))
+        
+        page, css = self._extract_styles(page)
+        tags = []
+        if css:
+            tags.append(f'<link rel="stylesheet" href="{self._asset("styles", "css", css)}"/>')
+        
+        def script(match):
+            body = match.group(1)
+            preload = ''
+            if self.SPLIT_TOKEN in body:
+                body = body.replace(self.SPLIT_TOKEN, '')
+                preload = ''.join(f'<script src="{src}"></script>' for src in pieces)
+            elif len(body) < self.min_inline:
+                return f"<script>{minify_code(body)}</script>"
+            return preload + f'<script src="{self._asset("map", "js", minify_code(body))}"></script>'
+        
+        page = self.INLINE_SCRIPT.sub(script, page)
+        if tags:
+            page = page.replace('</head>', ''.join(tags) + '</head>', 1)
+        
+        self._write(filename, minify_code(page))
+        return list(self.written)
+
+    def _split_elements(self):
+        """The EventRuntime and TemplatedEventData elements of the map"""
+        stack = [self.map_obj.map]
+        found = []
+        while stack:
+            element = stack.pop()
+            if isinstance(element, (EventRuntime, TemplatedEventData)):
+                found.append(element)
+            stack.extend(reversed(list(element._children.values())))
+        # Runtime first, data in page order
+        return sorted(found, key=lambda element: not isinstance(element, EventRuntime))
+
+    def _extract_styles(self, page):
+        """Moves repeated static inline styles to classes; returns page and CSS"""
+        counts = Counter(' '.join(style.split()) for _, style, _ in self.STYLE_ATTRIBUTE.findall(page))
+        # Styles filled in by JS templates stay inline
+        shared = [style for style, count in counts.most_common()
+                  if count > 1 and '${' not in style and '{' not in style]
+        classes = {style: f"ls{i:x}" for i, style in enumerate(shared)}
+        if not classes:
+            return page, ''
+        
+        def replace(match):
+            start, style, end = match.groups()
+            name = classes.get(' '.join(style.split()))
+            if name is None:
+                return match.group(0)
+            tag = start + end
+            existing = self.CLASS_ATTRIBUTE.search(tag)
+            if existing:
+                return tag[:existing.start()] + f' class="{existing.group(1)} {name}"' + tag[existing.end():]
+            return start + f' class="{name}"' + end
+        
+        page = self.STYLE_ATTRIBUTE.sub(replace, page)
+        rules = []
+        for style, name in classes.items():
+            declarations = [part.strip() for part in html.unescape(style).split(';') if part.strip()]
+            rules.append(f".{name}{{{';'.join(d + ' !important' for d in declarations)}}}")
+        return page, '\n'.join(rules) + '\n'
+
+    def _asset(self, name, extension, text):
+        """Writes a content-hashed asset; returns its URL relative to the page"""
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()[:12]
+        relative = f"{self.asset_dir}/{name}.{digest}.{extension}"
+        path = os.path.join(self.output_dir, relative)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._write(path, text)
+        else:
+            self.written.append(path)
+        return relative
+
+    def _write(self, path, text):
+        data = text.encode('utf-8')
+        with open(path, 'wb') as f:
+            f.write(data)
+        self.written.append(path)
+        if self.compress:
+            with open(path + '.gz', 'wb') as f:
+                f.write(gzip.compress(data, compresslevel=9, mtime=0))
+            if brotli is not None:
+                with open(path + '.br', 'wb') as f:
+                    f.write(brotli.compress(data, mode=brotli.MODE_TEXT))
+
+# ============================================================================
+# BATCH RENDERING
+# ============================================================================
+
+# Shared by the worker processes of VariantRenderer, set once per worker
+_variant_events = None
+_variant_fragments = None
+
+def _init_variant_worker(events, fragments):
+    global _variant_events, _variant_fragments
+    _variant_events = events
+    _variant_fragments = fragments
+
+def render_variant(spec, indices, stats_state, filename):
+    """Builds and saves one map variant (runs in a worker process)"""
+    start = time.perf_counter()
+    map_obj = UkraineMapWithImages(quiet=True, base=spec.get('base', 'osm'))
+    map_obj.fragments = _variant_fragments
+    events = [_variant_events[i] for i in indices]
+    
+    map_obj.index_events(events)
+    map_obj.add_markers_with_images(events, render_mode=spec.get('render_mode', 'auto'), filename=filename)
+    map_obj.add_extended_statistics(stats=StatisticsAccumulator.from_dict(stats_state))
+    map_obj.add_legend_with_images()
+    map_obj.add_layers()
+    map_obj.save(filename)
+    
+    return {
+        'name': spec['name'],
+        'filename': filename,
+        'events': len(events),
+        'seconds': round(time.perf_counter() - start, 4),
+        'bytes': os.path.getsize(filename),
+        'stages': map_obj.metrics()['stages'],
+    }
+
+class VariantRenderer:
+    """
+    Renders many map variants of one event set in parallel
+
+    A variant spec is a dict:
+        name        - required, also the default file name (<name>.html)
+        types       - event types to include (all if omitted)
+        oblasts     - oblasts to include; events without an 'oblast' get
+                      one from the map's gazetteer when it has oblast names
+        cities      - cities to include
+        days        - 'YYYY-MM-DD' dates, for events with a timestamp
+        base        - base layer from BASE_LAYERS ('osm', 'satellite', 'dark')
+        render_mode - as in add_markers_with_images, default 'auto'
+                      (resolved here with the map's bulk_threshold/bulk_engine)
+        filename    - output file, relative to output_dir
+
+    The events are partitioned once by (type, oblast, city, day), with a
+    StatisticsAccumulator per partition; a variant takes the partitions
+    it selects and merges their statistics instead of recounting. Popup
+    and tooltip HTML for the inline variants is rendered once and shared
+    with the process pool workers.
+    """
+
+    FILTERS = ('types', 'oblasts', 'cities', 'days')
+
+    def __init__(self, map_obj, events, output_dir='.', processes=None):
+        self.map_obj = map_obj
+        self.events = events
+        self.output_dir = output_dir
+        self.processes = processes
+        self.partitions = None
+
+    @staticmethod
+    def _day(event):
+        timestamp = event.get('timestamp')
+        return None if timestamp is None else datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')
+
+    def _oblasts(self):
+        """Oblast of every event, looked up in one batch for events without one"""
+        oblasts = [html.unescape(event.get('oblast') or '') for event in self.events]
+        missing = [i for i, oblast in enumerate(oblasts) if not oblast]
+        if missing and self.map_obj.gazetteer is not None and self.map_obj.gazetteer.oblasts:
+            _, found, _ = self.map_obj.nearest_cities(
+                [self.events[i]['lat'] for i in missing], [self.events[i]['lon'] for i in missing], oblasts=True
+            )
+            for i, oblast in zip(missing, found):
+                oblasts[i] = oblast
+        return oblasts
+
+    def partition(self):
+        """Groups event positions and statistics by (type, oblast, city, day), once"""
+        if self.partitions is None:
+            self.partitions = {}
+            for i, (event, oblast) in enumerate(zip(self.events, self._oblasts())):
+                key = (event['type'], oblast, event['city'], self._day(event))
+                partition = self.partitions.get(key)
+                if partition is None:
+                    partition = self.partitions[key] = ([], StatisticsAccumulator())
+                partition[0].append(i)
+                partition[1].update(event)
+        return self.partitions
+
+    def select(self, spec):
+        """Event positions (in input order) and merged statistics of a variant"""
+        filters = [set(spec[name]) if name in spec else None for name in self.FILTERS]
+        indices = []
+        stats = StatisticsAccumulator()
+        for key, (positions, partition_stats) in self.partition().items():
+            if all(allowed is None or value in allowed for value, allowed in zip(key, filters)):
+                indices.extend(positions)
+                stats.merge(partition_stats)
+        indices.sort()
+        return indices, stats
+
+    def _render_mode(self, spec, indices):
+        """A variant's render mode, with 'auto' resolved like add_markers_with_images"""
+        mode = spec.get('render_mode', 'auto')
+        if mode == 'auto':
+            mode = 'inline' if len(indices) <= self.map_obj.bulk_threshold else self.map_obj.bulk_engine
+        return mode
+
+    def _fragments(self, selections):
+        """Popup/tooltip HTML for every event of an inline variant, rendered once"""
+        fragments = {}
+        for spec, (indices, stats) in selections:
+            if spec['render_mode'] == 'inline':
+                for i in indices:
+                    event = self.events[i]
+                    if event['id'] not in fragments:
+                        fragments[event['id']] = (self.map_obj.create_popup_with_image(event),
+                                                  self.map_obj.create_tooltip(event))
+        return fragments
+
+    def run(self, specs):
+        """Renders every spec; returns per-variant results with timings"""
+        say = self.map_obj.say
+        instrumentation = self.map_obj.instrumentation
+        os.makedirs(self.output_dir, exist_ok=True)
+        
+        with instrumentation.stage('partition'):
+            selections = []
+            for spec in specs:
+                indices, stats = self.select(spec)
+                # Workers build default maps, so they get the resolved mode
+                selections.append((dict(spec, render_mode=self._render_mode(spec, indices)), (indices, stats)))
+            fragments = self._fragments(selections)
+        say(f"🧩 {len(specs)} variants over {len(self.partition())} partitions, "
+            f"{len(fragments)} popups pre-rendered")
+        
+        results = []
+        with instrumentation.stage('variants'):
+            with ProcessPoolExecutor(self.processes, initializer=_init_variant_worker,
+                                     initargs=(self.events, fragments)) as pool:
+                jobs = [
+                    pool.submit(render_variant, spec, indices, stats.to_dict(),
+                                os.path.join(self.output_dir, spec.get('filename', f"{spec['name']}.html")))
+                    for spec, (indices, stats) in selections
+                ]
+                for job in jobs:
+                    result = job.result()
+                    results.append(result)
+                    instrumentation.count('bytes_written', result['bytes'])
+                    say(f"🗺️ {result['name']}: {result['events']} events, "
+                        f"{result['seconds']:.2f}s -> {result['filename']}")
+        
+        return results
 
 # ============================================================================
 # EXECUTION
 # ============================================================================
 
-def main():
-    print("🚀 UKRAINE MAP WITH IMAGES")
-    print("=" * 32)
-    print("📸 Each marker has an image!")
-    print("🖼️ Sources: Unsplash + Wikimedia")
-    print("🔍 Click marker to see")
-    print("=" * 32)
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ukraine conflict map with images")
+    parser.add_argument('--quiet', action='store_true', help="no progress output")
+    parser.add_argument('--metrics', help="write stage timings and counters to this JSON file")
+    parser.add_argument('--profile', action='store_true', help="capture cProfile summaries per stage")
+    parser.add_argument('--gazetteer', help="GeoNames dump (e.g. UA.txt) to resolve cities from")
+    parser.add_argument('--admin1', help="GeoNames admin1CodesASCII.txt for oblast names")
+    parser.add_argument('--thumbnails', action='store_true', help="build popup thumbnails of the Pics images first")
+    args = parser.parse_args(argv)
+    
+    say = (lambda message: None) if args.quiet else print
+    
+    say("🚀 UKRAINE MAP WITH IMAGES")
+    say("=" * 32)
+    say("📸 Each marker has an image!")
+    say("🖼️ Sources: Unsplash + Wikimedia")
+    say("🔍 Click marker to see")
+    say("=" * 32)
     
     try:
         # Create map
-        map_obj = UkraineMapWithImages()
+        map_obj = UkraineMapWithImages(
+            instrumentation=Instrumentation(quiet=args.quiet, profile=args.profile),
+            gazetteer=Gazetteer.load(args.gazetteer, args.admin1) if args.gazetteer else None
+        )
+        
+        if args.thumbnails:
+            map_obj.prepare_thumbnails()
         
         # Generate and save
         map_obj.create_map_with_images()
         map_obj.save("ukraine_map_with_images.html")
+        if args.metrics:
+            map_obj.write_metrics(args.metrics)
         
-        print("\n🎉 SUCCESS!")
-        print("📁 Open: ukraine_map_with_images.html")
-        print("\n🎯 NEW FEATURES:")
-        print("• 📸 Images in every marker")
-        print("• 🖼️ Multiple image sources")
-        print("• 📊 Image source statistics")
-        print("• 🎨 Better popups with images")
-        print("• 🔍 Tooltips with preview")
-        print("• 📐 Coordinates in popups")
-        print("\n💡 INSTRUCTIONS:")
-        print("1. Click on any marker")
-        print("2. See image from location")
-        print("3. Read event details")
+        say("\n🎉 SUCCESS!")
+        say("📁 Open: ukraine_map_with_images.html")
+        say("\n🎯 NEW FEATURES:")
+        say("• 📸 Images in every marker")
+        say("• 🖼️ Multiple image sources")
+        say("• 📊 Image source statistics")
+        say("• 🎨 Better popups with images")
+        say("• 🔍 Tooltips with preview")
+        say("• 📐 Coordinates in popups")
+        say("\n💡 INSTRUCTIONS:")
+        say("1. Click on any marker")
+        say("2. See image from location")
+        say("3. Read event details")
         
     except Exception as e:
         print(f"❌ Error: {e}")
@@ -542,7 +4524,7 @@ def main():
 
 if __name__ == "__main__":
     # Requires: pip install folium
-    # Also requires: Pics folder with images 1.jpg to 10.jpg
+    # Also requires: Pics folder with images (1.jpg, 2.jpg, ...)
     main()
 
 """
@@ -550,14 +4532,16 @@ if __name__ == "__main__":
 
 ✅ LOCAL IMAGES IN MARKERS:
 - Each marker has image from Pics folder
-- Uses images 1.jpg to 10.jpg
-- Random selection from available images
+- Uses every image in the folder (jpg, png, gif, webp)
+- Folder is indexed once, rescanned only when it changes
+- Optional tags in file names (missile-strike_kyiv_1.jpg)
+- Random selection from matching images
 - 400x300px display size
 - Fallback for missing images
 
 🖼️ LOCAL IMAGE SOURCES:
 - Pics folder in same directory
-- Images named 1.jpg, 2.jpg, ... 10.jpg
+- Any images in the folder (1.jpg, 2.jpg, ...)
 - Automatic folder creation if missing
 - Error handling for missing files
 
@@ -582,7 +4566,7 @@ if __name__ == "__main__":
 
 SETUP:
 1. Create 'Pics' folder in same directory as .py file
-2. Add images named 1.jpg, 2.jpg, 3.jpg, ... up to 10.jpg
+2. Add images (1.jpg, 2.jpg, ... or tagged names like drone-attack_1.jpg)
 3. pip install folium
 4. python filename.py
 